@@ -0,0 +1,297 @@
+import hashlib
+import json
+import numpy as np
+import os
+import re
+import tempfile
+
+from utils import defaultNormFactors
+
+
+# Fixed parameters of the Asimov dataset
+asimovSettings = {
+    "mu": 0.0,
+    "Zhf": defaultNormFactors["Zhf"],
+    "ttbar": defaultNormFactors["ttbar"],
+}
+
+
+def getRegions(mass):
+    """Returns name of the region (label of `channelCat`) per channel"""
+    return {
+        "hh": f"Region_BMin0_incJet1_distPNN{mass}_J2_Y2015_DLLOS_T2_SpcTauHH_L0",
+        "lh_slt": f"Region_BMin0_incJet1_dist{mass}_J2_D2HDMPNN_T2_SpcTauLH_Y2015_LTT0_L1",
+        "lh_ltt": f"Region_BMin0_incJet1_dist{mass}_J2_D2HDMPNN_T2_SpcTauLH_Y2015_LTT1_L1",
+        "zcr": "Region_BMin0_incJet1_Y2015_DZllbbCR_T2_L2_distmLL_J2",
+    }
+
+
+def getBinEdges(observable):
+    binning = observable.getBinning()
+    return np.array([binning.binLow(i) for i in range(binning.numBins())]
+                    + [binning.highBound()])
+
+
+def splitAsimov(dataset, regions):
+    """Returns (observable values, weights) per channel
+
+    The dataset is split by `channelCat` in a single pass over the
+    entries. The weights are taken from the dataset entry by entry which
+    also works for the Asimov dataset from `MakeAsimovData`.
+    """
+    channels = {region: channel for channel, region in regions.items()}
+    values = {channel: [] for channel in regions}
+    weights = {channel: [] for channel in regions}
+
+    for i in range(dataset.numEntries()):
+        argset = dataset.get(i)
+
+        channel = channels.get(argset.getCatLabel("channelCat"))
+        if channel is None:
+            continue
+
+        values[channel].append(argset.getRealValue(f"obs_x_{regions[channel]}"))
+        weights[channel].append(dataset.weight())
+
+    return {channel: (np.array(values[channel]), np.array(weights[channel]))
+            for channel in regions}
+
+
+# Global observables of the gamma NPs
+gammaGlobPattern = re.compile(
+    r"^nom_gamma_stat_Region_BMin0_incJet1_.*"
+    r"(DZllbbCR|SpcTauHH|SpcTauLH_Y2015_LTT0|SpcTauLH_Y2015_LTT1)"
+    r".*_bin_(\d+)$"
+)
+
+
+def getGammaGlobs(model):
+    """Returns values of the gamma global observables (ordered by bin) per channel"""
+    gamma_globs = {}
+    for param in model.GetGlobalObservables():
+        name = param.GetName()
+        m = gammaGlobPattern.match(name)
+        if not m:
+            continue
+
+        region, ibin = m.groups()
+        ibin = int(ibin)
+
+        if region == "SpcTauHH":
+            region = "hh"
+        elif region == "SpcTauLH_Y2015_LTT0":
+            region = "lh_slt"
+        elif region == "SpcTauLH_Y2015_LTT1":
+            region = "lh_ltt"
+        elif region == "DZllbbCR":
+            region = "zcr"
+        else:
+            raise RuntimeError("Unknown value encountered for region")
+
+        gamma_globs.setdefault(region, []).append((ibin, param.getVal()))
+
+    return {key: np.array([glob for ibin, glob in sorted(values, key=lambda x: x[0])])
+            for key, values in gamma_globs.items()}
+
+
+def makeAsimovHists(workspace, mass):
+    """Returns histograms of the Asimov dataset and tau of a workspace
+
+    The histograms are returned as {name: (edges, contents, errors)} so
+    that they can be passed between processes.
+    """
+    import ROOT as R
+    R.gROOT.SetBatch(True)
+
+    f = R.TFile.Open(workspace)
+    w = f.Get("combined")
+    model = w.obj("ModelConfig")
+
+    # POI
+    mu = model.GetParametersOfInterest().first()
+    mu.setVal(asimovSettings["mu"])
+    mu.setConstant()
+
+    # Norm factors
+    zhf_nf = None
+    ttbar_nf = None
+    for param in model.GetNuisanceParameters():
+        name = param.GetName()
+        if name == "ATLAS_norm_Zhf":
+            zhf_nf = param
+        elif name == "ATLAS_norm_ttbar":
+            ttbar_nf = param
+
+    zhf_nf.setVal(asimovSettings["Zhf"])
+    zhf_nf.setConstant()
+
+    ttbar_nf.setVal(asimovSettings["ttbar"])
+    ttbar_nf.setConstant()
+
+    asimov = R.RooStats.AsymptoticCalculator.MakeAsimovData(
+        model,
+        R.RooArgSet(mu, zhf_nf, ttbar_nf),
+        model.GetGlobalObservables())
+
+    hists = {}
+
+    # Histograms of Asimov observables
+    regions = getRegions(mass)
+    for channel, (values, weights) in splitAsimov(asimov, regions).items():
+        edges = getBinEdges(w.obj(f"obs_x_{regions[channel]}"))
+        contents, _ = np.histogram(values, bins=edges, weights=weights)
+        sumw2, _ = np.histogram(values, bins=edges, weights=weights**2)
+
+        hists[f"obs_{channel}_m{mass}"] = (edges, contents, np.sqrt(sumw2))
+
+    # Asimov global observables
+    gamma_globs = getGammaGlobs(model)
+    for channel in regions:
+        globs = gamma_globs[channel]
+        if channel == "zcr":
+            edges = np.linspace(75, 110, len(globs) + 1)
+        else:
+            edges = np.linspace(0, 1, len(globs) + 1)
+
+        hists[f"tau_{channel}_m{mass}"] = (edges, globs, np.sqrt(globs))
+
+    f.Close()
+    return hists
+
+
+def writeAsimovHists(fout, hists):
+    """Writes histograms from `makeAsimovHists` as TH1F to an open TFile"""
+    import ROOT as R
+
+    for name, (edges, contents, errors) in hists.items():
+        h = R.TH1F(name, name, len(edges) - 1, edges)
+        h.SetDirectory(0)
+
+        for i, (content, error) in enumerate(zip(contents, errors), start=1):
+            h.SetBinContent(i, content)
+            h.SetBinError(i, error)
+
+        fout.WriteTObject(h)
+
+
+# Bump to invalidate existing caches when the histograms change
+asimovCacheVersion = 1
+
+
+class AsimovCache:
+    """Content-addressed cache of the histograms from `makeAsimovHists`
+
+    Entries are keyed by the hash of the workspace content, the mass
+    point and `asimovSettings`. Histograms are stored once per content,
+    i.e. mass-independent regions (Z-CR) are shared by all mass points.
+
+    Layout of the cache directory:
+    - files/<hash of path>.json: Content hash of a workspace by path,
+      size and mtime
+    - entries/<key>.json: Content hash of every histogram of an entry
+    - hists/<hash>.npz: Edges, contents and errors of a histogram
+
+    Every file is written once to a unique temporary file and then
+    renamed, so concurrent runs sharing the cache do not interfere.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        for subdir in ["files", "entries", "hists"]:
+            os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+
+    def _fileFilename(self, path):
+        path_hash = hashlib.sha256(path.encode()).hexdigest()
+        return os.path.join(self.directory, "files", f"{path_hash}.json")
+
+    def fileHash(self, filename):
+        """Returns sha256 of the file content (only rehashed if the file changed)"""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        stat_key = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+        file_fn = self._fileFilename(path)
+
+        entry = None
+        if os.path.exists(file_fn):
+            with open(file_fn) as fin:
+                entry = json.load(fin)
+
+        if entry is None or entry["path"] != path or entry["key"] != stat_key:
+            sha = hashlib.sha256()
+            with open(path, "rb") as fin:
+                for block in iter(lambda: fin.read(1 << 24), b""):
+                    sha.update(block)
+
+            entry = {"path": path, "key": stat_key, "sha256": sha.hexdigest()}
+            self._writeJson(file_fn, entry)
+
+        return entry["sha256"]
+
+    def key(self, workspace, mass):
+        content = {
+            "version": asimovCacheVersion,
+            "workspace": self.fileHash(workspace),
+            "mass": mass,
+            "settings": asimovSettings,
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def _entryFilename(self, key):
+        return os.path.join(self.directory, "entries", f"{key}.json")
+
+    def _histFilename(self, content_hash):
+        return os.path.join(self.directory, "hists", f"{content_hash}.npz")
+
+    def _replace(self, filename, write, mode):
+        # Unique temporary file per writer, renamed atomically
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+        try:
+            with os.fdopen(fd, mode) as fout:
+                write(fout)
+
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _writeJson(self, filename, obj):
+        self._replace(filename, lambda fout: json.dump(obj, fout, indent=1, sort_keys=True), "w")
+
+    def has(self, key):
+        return os.path.exists(self._entryFilename(key))
+
+    def get(self, key):
+        with open(self._entryFilename(key)) as fin:
+            entry = json.load(fin)
+
+        hists = {}
+        for name, content_hash in entry.items():
+            with np.load(self._histFilename(content_hash)) as arrays:
+                hists[name] = (arrays["edges"], arrays["contents"], arrays["errors"])
+
+        return hists
+
+    def put(self, key, hists):
+        entry = {}
+        for name, (edges, contents, errors) in hists.items():
+            arrays = {
+                "edges": np.asarray(edges, dtype=np.float64),
+                "contents": np.asarray(contents, dtype=np.float64),
+                "errors": np.asarray(errors, dtype=np.float64),
+            }
+
+            sha = hashlib.sha256()
+            for array in arrays.values():
+                sha.update(np.array(array.shape, dtype=np.int64).tobytes())
+                sha.update(array.tobytes())
+
+            content_hash = sha.hexdigest()
+            hist_fn = self._histFilename(content_hash)
+            if not os.path.exists(hist_fn):
+                self._replace(hist_fn, lambda fout: np.savez(fout, **arrays), "wb")
+
+            entry[name] = content_hash
+
+        # Written last so that incomplete entries are never used
+        self._writeJson(self._entryFilename(key), entry)
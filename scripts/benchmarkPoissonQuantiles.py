@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+from scipy import stats
+import argparse
+import numpy as np
+import time
+
+from toy_utils import PoissonQuantileTable
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--nbins", type=int, default=200)
+parser.add_argument("--ntoys", type=int, default=10000)
+parser.add_argument("--mu-min", type=float, default=0.1)
+parser.add_argument("--mu-max", type=float, default=1e5)
+args = parser.parse_args()
+
+
+rng = np.random.default_rng(82340981231)
+
+# Expected rates spread (log-uniform) over the range of the bins
+mu = np.exp(rng.uniform(np.log(args.mu_min), np.log(args.mu_max), size=args.nbins))
+rnd = rng.standard_normal(size=(args.ntoys, args.nbins))
+
+
+start = time.perf_counter()
+rvs_scipy = stats.poisson.ppf(stats.norm.cdf(rnd), mu=mu)
+time_scipy = time.perf_counter() - start
+
+start = time.perf_counter()
+quantiles = PoissonQuantileTable(mu)
+time_setup = time.perf_counter() - start
+
+start = time.perf_counter()
+rvs_table = quantiles.fromNormal(rnd)
+time_table = time.perf_counter() - start
+
+
+print(f"Bins: {args.nbins}, toys: {args.ntoys}")
+print(f"Table entries: {quantiles.size}")
+print(f"scipy: {time_scipy:.3f} s")
+print(f"Table: {time_table:.3f} s (setup: {time_setup:.3f} s)")
+print(f"Speed-up: {time_scipy / time_table:.1f}")
+
+ndiff = np.count_nonzero(rvs_scipy != rvs_table)
+print(f"Differences to scipy: {ndiff}")
+if ndiff != 0:
+    raise RuntimeError("Results differ from scipy")
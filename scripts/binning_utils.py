@@ -0,0 +1,224 @@
+import h5py
+import numpy as np
+import os
+import re
+
+
+# Version of the file format (increment on incompatible changes)
+binningVersion = 1
+
+# Default name of the binning file written by parseBins.py
+binningFilename = "binning.h5"
+
+# Environment variable to override the location of the binning file
+binningEnvVar = "BINNING_FILE"
+
+channels = ["hadhad", "slt", "ltt"]
+
+
+# Bin edges before rebinning (i.e. original histograms)
+edgesHadhadPreRebin = np.linspace(0, 1, 1001, dtype=np.float64)
+
+edgesLephadPreRebin = np.concatenate([
+    np.arange(991, dtype=np.float64) / 1000.,
+    0.99 + np.arange(1, 101, dtype=np.float64) / 10000.
+])
+
+
+# Categories of the channels in the WSMaker build logs
+categoryPatterns = {
+    "hadhad": re.compile(
+        r"INFO::Category: In category "
+        r"Region_BMin0_incJet1_distPNN(\d+)_J2_Y2015_DLLOS_T2_SpcTauHH_L0$"),
+    "slt": re.compile(
+        r"INFO::Category: In category "
+        r"Region_BMin0_incJet1_dist(\d+)_J2_D2HDMPNN_T2_SpcTauLH_Y2015_LTT0_L1$"),
+    "ltt": re.compile(
+        r"INFO::Category: In category "
+        r"Region_BMin0_incJet1_dist(\d+)_J2_D2HDMPNN_T2_SpcTauLH_Y2015_LTT1_L1$"),
+}
+
+binPattern = re.compile(r"Bin (\d+) (\d+)")
+nbinPattern = re.compile(r"^nbin \d+$")
+
+
+def parseBuildLog(filename):
+    """Returns (mass, {channel: bin indices}) from a WSMaker build log
+
+    The log is read line by line in a single pass. The block of a channel
+    starts at the first `In category` line of its region and ends at the
+    next `nbin` line. The `Bin i j` lines of the block are ordered by
+    descending `i`.
+    """
+    blocks = {}
+    channel = None
+
+    with open(filename, "r", errors="replace") as fin:
+        for line in fin:
+            line = line.rstrip("\n")
+
+            if channel is None:
+                if "In category" not in line:
+                    continue
+
+                for name, pattern in categoryPatterns.items():
+                    if name in blocks:
+                        continue
+
+                    m = pattern.search(line)
+                    if m:
+                        channel = name
+                        blocks[channel] = (int(m.group(1)), [])
+                        break
+
+                continue
+
+            if nbinPattern.match(line):
+                channel = None
+                if len(blocks) == len(categoryPatterns):
+                    break
+                continue
+
+            blocks[channel][1].extend((int(i), int(j)) for i, j in binPattern.findall(line))
+
+    if channel is not None:
+        raise RuntimeError(f"Unterminated category {channel} in {filename}")
+
+    missing = [name for name in categoryPatterns if name not in blocks]
+    if missing:
+        raise RuntimeError(f"Categories not found in {filename}: {', '.join(missing)}")
+
+    masses = {mass for mass, _ in blocks.values()}
+    if len(masses) != 1:
+        raise RuntimeError(f"Inconsistent mass points in {filename}: "
+                           + ", ".join(f"{name} {blocks[name][0]}" for name in channels))
+
+    bin_idx = {name: np.array([j for i, j in sorted(bins, key=lambda x: x[0], reverse=True)],
+                              dtype=np.int64)
+               for name, (_, bins) in blocks.items()}
+
+    return masses.pop(), bin_idx
+
+
+def getEdges(bin_idx):
+    """Returns bin edges (after rebinning) per channel from the bin indices"""
+    return {
+        "hadhad": (np.array(bin_idx["hadhad"], dtype=np.float64) - 1.) / 1000.,
+        "slt": edgesLephadPreRebin[bin_idx["slt"] - 1],
+        "ltt": edgesLephadPreRebin[bin_idx["ltt"] - 1],
+    }
+
+
+def writeBinning(filename, edges):
+    """Writes bin edges given as {channel: {mass: edges}}"""
+    with h5py.File(filename, "w") as fout:
+        fout.attrs["version"] = binningVersion
+
+        for channel in channels:
+            group = fout.create_group(channel)
+            masses = sorted(edges[channel])
+            group.create_dataset("masses", data=np.array(masses, dtype=int))
+            for mass in masses:
+                group.create_dataset(str(mass), data=np.asarray(edges[channel][mass],
+                                                                dtype=np.float64))
+
+
+def loadBinning(filename, channel):
+    """Returns bin edges (after rebinning) of a channel by mass point"""
+    if not os.path.exists(filename):
+        raise RuntimeError(f"Binning file not found: {filename} (see parseBins.py)")
+
+    with h5py.File(filename, "r") as fin:
+        version = fin.attrs.get("version")
+        if version != binningVersion:
+            raise RuntimeError(f"Unsupported version of binning {filename}: {version}")
+
+        if channel not in fin:
+            raise RuntimeError(f"Channel {channel} not found in {filename}")
+
+        group = fin[channel]
+        return {int(mass): np.array(group[str(mass)]) for mass in group["masses"]}
+
+
+def getBinCenters(binningPostRebin):
+    """Returns bin centers by mass point from the bin edges"""
+    return {mass: 0.5 * (edges[:-1] + edges[1:]) for mass, edges in binningPostRebin.items()}
+
+
+def getBinIndexMap(binning, centers):
+    """Returns mapping of post-rebin bin (0-based) to pre-rebin bin index
+
+    Takes the post-rebin bin centers by mass point. Can just put data at
+    center of bin since the rebinning will again be performed when
+    building the workspace.
+    """
+    # Using `side="right"` to mimic ROOT convention of 0 being underflow bin
+    return {mass: np.searchsorted(binning, mass_centers, side="right")
+            for mass, mass_centers in centers.items()}
+
+
+class BinningRegistry:
+    """Bin edges of all channels, loaded on first access and memoized
+
+    The binning file is taken from `configure(filename)`, otherwise from
+    the environment variable `BINNING_FILE` or `binning.h5` in the working
+    directory. Derived lookups (bin centers, bin index map) are computed
+    once per channel.
+    """
+
+    def __init__(self, filename=None):
+        self._filename = filename
+        self._cache = {}
+
+    @property
+    def filename(self):
+        if self._filename is not None:
+            return self._filename
+
+        return os.environ.get(binningEnvVar, binningFilename)
+
+    def configure(self, filename):
+        """Sets location of the binning file (drops everything loaded so far)"""
+        self._filename = filename
+        self._cache.clear()
+
+    def _memoize(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+
+        return self._cache[key]
+
+    def _checkChannel(self, channel):
+        if channel not in channels:
+            raise RuntimeError(f"Unknown channel: {channel}")
+
+    def preRebinEdges(self, channel):
+        """Returns bin edges before rebinning (i.e. original histograms)"""
+        self._checkChannel(channel)
+        return edgesHadhadPreRebin if channel == "hadhad" else edgesLephadPreRebin
+
+    def edges(self, channel):
+        """Returns bin edges after rebinning by mass point"""
+        self._checkChannel(channel)
+        return self._memoize(("edges", channel),
+                             lambda: loadBinning(self.filename, channel))
+
+    def masses(self, channel):
+        return sorted(self.edges(channel))
+
+    def centers(self, channel):
+        """Returns bin centers after rebinning by mass point"""
+        return self._memoize(("centers", channel),
+                             lambda: getBinCenters(self.edges(channel)))
+
+    def binIndexMap(self, channel):
+        """Returns post-rebin bin (0-based) to pre-rebin bin index by mass point
+
+        See `getBinIndexMap`.
+        """
+        return self._memoize(("bin_idx_map", channel), lambda: getBinIndexMap(
+            self.preRebinEdges(channel), self.centers(channel)))
+
+
+# Shared by all modules of a process
+binningRegistry = BinningRegistry()
@@ -0,0 +1,133 @@
+import h5py
+import numpy as np
+import os
+import pandas as pd
+
+from utils import masspoints
+
+
+# Version of the file format (increment on incompatible changes)
+cellsVersion = 1
+
+
+def cellsFilename(dataframe_filename):
+    """Returns the default location of the cell index of a dataframe"""
+    base, ext = os.path.splitext(dataframe_filename.rstrip(os.sep))
+    return f"{base}_cells.h5"
+
+
+def getCellIndex(df, by_sample=True):
+    """Returns cells (bins and sample) and the cell index of every event"""
+    signature = np.stack([np.asarray(df[f"PNN{mass}Bin"], dtype=np.uint8)
+                          for mass in masspoints], axis=1)
+
+    if by_sample:
+        sample = df["sample"].astype("category")
+        codes = np.asarray(sample.cat.codes, dtype=np.int16)
+
+        # Sample code stored in two additional bytes of the signature
+        signature = np.concatenate(
+            [signature, codes.astype(">i2").view(np.uint8).reshape(-1, 2)], axis=1)
+
+    signature, inverse = np.unique(signature, axis=0, return_inverse=True)
+
+    cells = pd.DataFrame({
+        f"PNN{mass}Bin": signature[:, i] for i, mass in enumerate(masspoints)
+    })
+
+    if by_sample:
+        cell_codes = signature[:, -2:].copy().view(">i2").ravel().astype(np.int16)
+        cells["sample"] = pd.Categorical.from_codes(cell_codes, sample.cat.categories)
+
+    return cells, inverse.ravel()
+
+
+def getCells(df, by_sample=True, return_index=False):
+    """Returns dataframe with one row per unique bin signature and sample
+
+    A cell collects all events of a sample that fall into the same
+    bins for all mass points. Every cell stores the sum of weights
+    (`weight`), sum of weights squared (`weightSquared`) and number of
+    events (`count`).
+
+    If `return_index` is set, (cells, cell index of every event) is returned.
+    """
+    cells, inverse = getCellIndex(df, by_sample)
+
+    weight = np.asarray(df["weight"], dtype=np.float64)
+    if "weightSquared" in df.columns:
+        weight2 = np.asarray(df["weightSquared"], dtype=np.float64)
+    else:
+        weight2 = weight**2
+
+    ncells = len(cells)
+    cells["weight"] = np.bincount(inverse, weights=weight, minlength=ncells)
+    cells["weightSquared"] = np.bincount(inverse, weights=weight2, minlength=ncells)
+    cells["count"] = np.bincount(inverse, minlength=ncells)
+
+    if return_index:
+        return cells, inverse
+
+    return cells
+
+
+def mergeCells(cells):
+    """Returns the cells of the concatenation of the given cells"""
+    df = pd.concat(cells, ignore_index=True)
+    df["sample"] = df["sample"].astype("category")
+
+    keys = [f"PNN{mass}Bin" for mass in masspoints] + ["sample"]
+    merged = df.groupby(keys, observed=True, sort=True)[["weight", "weightSquared", "count"]].sum()
+
+    return merged.reset_index()
+
+
+def writeCells(filename, cells):
+    samples = list(cells["sample"].cat.categories)
+
+    with h5py.File(filename, "w") as fout:
+        fout.attrs["version"] = cellsVersion
+        fout.create_dataset("masses", data=np.array(masspoints, dtype=int))
+        fout.create_dataset(
+            "bins",
+            data=np.stack([cells[f"PNN{mass}Bin"] for mass in masspoints],
+                          axis=1).astype(np.uint8),
+            compression="gzip")
+        fout.create_dataset("samples", data=np.array(samples, dtype="S"))
+        fout.create_dataset("sample", data=np.asarray(cells["sample"].cat.codes, dtype=np.int16),
+                            compression="gzip")
+        fout.create_dataset("sumw", data=np.asarray(cells["weight"], dtype=np.float64),
+                            compression="gzip")
+        fout.create_dataset("sumw2", data=np.asarray(cells["weightSquared"], dtype=np.float64),
+                            compression="gzip")
+        fout.create_dataset("count", data=np.asarray(cells["count"], dtype=np.int64),
+                            compression="gzip")
+
+
+def describeCells(filename):
+    """Returns {file, key, nrows} identifying a cell index"""
+    with h5py.File(filename, "r") as fin:
+        return {"file": os.path.abspath(filename), "key": "cells", "nrows": int(len(fin["sumw"]))}
+
+
+def loadCells(filename):
+    """Loads cell index (same columns as returned by `getCells`)"""
+    with h5py.File(filename, "r") as fin:
+        version = fin.attrs.get("version")
+        if version != cellsVersion:
+            raise RuntimeError(f"Unsupported version of cell index {filename}: {version}")
+
+        masses = list(np.array(fin.get("masses")))
+        bins = np.array(fin.get("bins"))
+        samples = [s.decode() for s in fin.get("samples")]
+        sample = np.array(fin.get("sample"))
+
+        cells = pd.DataFrame({
+            f"PNN{mass}Bin": bins[:, i] for i, mass in enumerate(masses)
+        })
+        cells["sample"] = pd.Categorical.from_codes(sample, samples)
+        cells["weight"] = np.array(fin.get("sumw"))
+        cells["weightSquared"] = np.array(fin.get("sumw2"))
+        cells["count"] = np.array(fin.get("count"))
+
+    return cells
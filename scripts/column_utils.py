@@ -0,0 +1,128 @@
+import json
+import numpy as np
+import os
+import pandas as pd
+
+from utils import masspoints
+
+
+# Directory with one memory-mappable .npy file per column and meta.json
+# describing the columns. Only the columns needed by the toy generation
+# are stored: weight, sample (codes of the categories) and PNN{mass}Bin
+# (and optionally the PNN scores).
+columnsVersion = 1
+
+
+def isColumnar(path):
+    return os.path.isdir(path)
+
+
+def writeColumns(directory, df, weight_dtype=np.float64, keep_scores=False):
+    """Writes the columns of a binned dataframe in the columnar format"""
+    os.makedirs(directory, exist_ok=True)
+
+    sample = df["sample"].astype("category")
+
+    arrays = {
+        "weight": df["weight"].to_numpy(dtype=weight_dtype),
+        "sample": sample.cat.codes.to_numpy(),
+    }
+    for mass in masspoints:
+        arrays[f"PNN{mass}Bin"] = df[f"PNN{mass}Bin"].to_numpy(dtype=np.uint8)
+    if keep_scores:
+        for mass in masspoints:
+            arrays[f"PNN{mass}"] = df[f"PNN{mass}"].to_numpy()
+
+    meta = {
+        "version": columnsVersion,
+        "nrows": len(df),
+        "columns": {},
+    }
+    for name, arr in arrays.items():
+        np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(arr))
+        meta["columns"][name] = {"file": f"{name}.npy", "dtype": arr.dtype.str}
+
+    meta["columns"]["sample"]["categories"] = [str(c) for c in sample.cat.categories]
+
+    # Written last, i.e. only complete directories can be loaded
+    with open(os.path.join(directory, "meta.json"), "w") as fout:
+        json.dump(meta, fout, indent=1)
+
+
+def loadMeta(directory):
+    with open(os.path.join(directory, "meta.json")) as fin:
+        meta = json.load(fin)
+
+    if meta.get("version") != columnsVersion:
+        raise RuntimeError(f"Unsupported version of columnar dataframe: {directory}")
+
+    return meta
+
+
+def loadColumns(directory, columns=None):
+    """Returns read-only memory-mapped arrays of the columns
+
+    The `sample` column holds the codes of the categories given by
+    `loadMeta(directory)["columns"]["sample"]["categories"]`.
+    """
+    meta = loadMeta(directory)
+    if columns is None:
+        columns = list(meta["columns"])
+
+    arrays = {}
+    for name in columns:
+        if name not in meta["columns"]:
+            raise RuntimeError(f"Column {name} not found in {directory}")
+
+        filename = os.path.join(directory, meta["columns"][name]["file"])
+        # Plain array view of the memory map (pandas copies memmap instances)
+        arrays[name] = np.asarray(np.load(filename, mmap_mode="r"))
+
+    return arrays
+
+
+def loadDataframe(directory, columns=None, start=None, stop=None):
+    """Returns dataframe of rows [start, stop) backed by the memory-mapped columns"""
+    meta = loadMeta(directory)
+    start, stop, _ = slice(start, stop).indices(meta["nrows"])
+
+    arrays = {name: arr[start:stop] for name, arr in loadColumns(directory, columns).items()}
+
+    if "sample" in arrays:
+        categories = meta["columns"]["sample"]["categories"]
+        arrays["sample"] = pd.Categorical.from_codes(arrays["sample"], categories=categories)
+
+    return pd.DataFrame(arrays, index=pd.RangeIndex(start, stop), copy=False)
+
+
+def readDataframe(path, columns=None, start=None, stop=None, chunksize=None):
+    """Reads a dataframe from HDF5 or the columnar format (see `pd.read_hdf`)
+
+    Returns an iterator over chunks of rows if `chunksize` is given.
+    """
+    if not isColumnar(path):
+        return pd.read_hdf(path, columns=columns, start=start, stop=stop, chunksize=chunksize)
+
+    if chunksize is None:
+        return loadDataframe(path, columns, start, stop)
+
+    nrows = loadMeta(path)["nrows"]
+    start, stop, _ = slice(start, stop).indices(nrows)
+
+    return (loadDataframe(path, columns, chunk_start, min(chunk_start + chunksize, stop))
+            for chunk_start in range(start, stop, chunksize))
+
+
+def describeDataframe(path):
+    """Returns {file, key, nrows} identifying a dataframe (HDF5 or columnar)"""
+    if isColumnar(path):
+        return {"file": os.path.abspath(path), "key": "", "nrows": int(loadMeta(path)["nrows"])}
+
+    with pd.HDFStore(path, "r") as store:
+        # Categorical columns are stored with metadata below the dataframe
+        keys = [key for key in store.keys() if "/meta/" not in key]
+        if len(keys) != 1:
+            raise RuntimeError(f"Expected a single dataframe in {path}, found: {', '.join(keys)}")
+
+        return {"file": os.path.abspath(path), "key": keys[0],
+                "nrows": int(store.get_storer(keys[0]).nrows)}
@@ -1,13 +1,11 @@
 #!/usr/bin/env python
-from scipy import stats
 from tqdm import tqdm
 import argparse
 import h5py
 import matplotlib.pyplot as plt
 import numpy as np
-import uproot
 
-from utils import masspoints
+from toy_utils import CorrelatedNormalSampler, PoissonQuantileTable, getExpectedRates
 
 
 parser = argparse.ArgumentParser()
@@ -15,6 +13,8 @@ parser.add_argument("infile_corr")
 parser.add_argument("infile_asimov")
 parser.add_argument("-c", "--channel", choices=["Hadhad", "SLT", "LTT"], required=True)
 parser.add_argument("-o", "--outfile", default=None)
+parser.add_argument("--factor-cache", default=None,
+                    help="File to cache the decomposition of the correlation matrix in")
 args = parser.parse_args()
 
 
@@ -28,30 +28,7 @@ with h5py.File(args.infile_corr, "r") as fin:
 
 
 # Read Asimov (for expected background)
-asimov_hists = {}
-with uproot.open(args.infile_asimov) as fin:
-    for mass in masspoints:
-        if args.channel == "Hadhad":
-            hname = f"obs_hh_m{mass}"
-        elif args.channel == "SLT":
-            hname = f"obs_lh_slt_m{mass}"
-        elif args.channel == "LTT":
-            hname = f"obs_lh_ltt_m{mass}"
-        else:
-            raise RuntimeError("Unknown channel")
-
-        asimov_hists[mass] = fin[hname].to_numpy()
-
-
-# Build vector of expected rates
-mu = []
-for mass, ibin in bin_labels:
-    hist, edges = asimov_hists[mass]
-    # Histograms loaded with uproot do not contain over / underflows
-    # but these are counted in bin_labels
-    mu.append(hist[ibin - 1])
-
-mu = np.array(mu)
+mu = getExpectedRates(args.infile_asimov, args.channel, bin_labels)
 
 
 # Scale up expected yields to be in a ~Gaussian regime
@@ -63,22 +40,20 @@ print(f"Apply SF: {sf:.1f}")
 mu = sf * mu
 print(f"Minimum expected rate after scaling: {mu.min():.2f}")
 
-# Diagonalize correlation matrix
-eigval, eigvec = np.linalg.eigh(corr)
+# Decomposition of the correlation matrix (optionally cached)
+sampler = CorrelatedNormalSampler.fromFile(args.infile_corr, cache=args.factor_cache)
 with np.printoptions(precision=3, suppress=True):
-    print(f"\nEigenvalues:\n{eigval}")
+    print(f"\nEigenvalues:\n{sampler.eigval}")
 
-eigval[eigval < 1e-12] = 0.0
+# Lookup tables of the Poisson quantile function
+quantiles = PoissonQuantileTable(mu)
 
 # Multivariate normal RVS
 gaus = []
 pois = []
 
 for batch in tqdm(range(50)):
-    rnd = stats.norm.rvs(size=(10000, len(eigval)), random_state=rng)
-    rnd *= np.sqrt(eigval)
-    # Beware: crazy broadcasting
-    rnd = (rnd[:, :, np.newaxis] * eigvec.T[np.newaxis]).sum(axis=1)
+    rnd = sampler.rvs(10000, rng)
 
     # Use Gaussian approximation
     gaus.append(
@@ -87,7 +62,7 @@ for batch in tqdm(range(50)):
 
     # Copula approach
     pois.append(
-        stats.poisson.ppf(stats.norm.cdf(rnd), mu=mu).astype(np.float32)
+        quantiles.fromNormal(rnd).astype(np.float32)
     )
 
 gaus = np.concatenate(gaus)
@@ -0,0 +1,299 @@
+import h5py
+import json
+import numpy as np
+from scipy import sparse
+
+from utils import masspoints, normFactorSamples
+
+
+def updateUniqueBins(unique_bins, df):
+    """Adds the PNN bins populated in the dataframe to `unique_bins`"""
+    for mass in masspoints:
+        unique_bins.setdefault(mass, set()).update(
+            int(ibin) for ibin in np.unique(df[f"PNN{mass}Bin"]))
+
+
+def getBinLabels(unique_bins):
+    """Returns the sorted list of (mass, bin) pairs"""
+    all_bins = []
+    for mass in sorted(unique_bins):
+        for ibin in sorted(unique_bins[mass]):
+            all_bins.append((mass, ibin))
+
+    return all_bins
+
+
+def getBinMembership(df, all_bins, weights=None):
+    """Returns sparse (event x bin) matrix with one entry per event and mass
+
+    The entries are `weights` (or ones if not given).
+    """
+    masses = sorted({mass for mass, ibin in all_bins})
+
+    # Lookup table from PNN bin index (fits uint8) to column index
+    columns = np.zeros((len(masses), 256), dtype=np.int64) - 1
+    for i, (mass, ibin) in enumerate(all_bins):
+        columns[masses.index(mass), ibin] = i
+
+    # Every event is in exactly one bin per mass point
+    indices = np.stack([columns[k, np.asarray(df[f"PNN{mass}Bin"])]
+                        for k, mass in enumerate(masses)], axis=1)
+
+    if np.any(indices < 0):
+        raise RuntimeError("Events found in bins that are not part of the bin labels")
+
+    nevents = indices.shape[0]
+    indptr = np.arange(0, nevents * len(masses) + 1, len(masses))
+
+    if weights is None:
+        data = np.ones(indices.size, dtype=np.float64)
+    else:
+        data = np.repeat(np.asarray(weights, dtype=np.float64), len(masses))
+
+    return sparse.csr_matrix((data, indices.ravel(), indptr),
+                             shape=(nevents, len(all_bins)))
+
+
+def getCooccurrence(df, all_bins):
+    """Returns (bin x bin) sum of weights / weights^2 of events in both bins
+
+    Rows of `df` can also be cells (see `cell_utils.getCells`) with
+    the sum of weights squared given in column `weightSquared`.
+    """
+    weight = np.asarray(df["weight"], dtype=np.float64)
+    if "weightSquared" in df.columns:
+        weight2 = np.asarray(df["weightSquared"], dtype=np.float64)
+    else:
+        weight2 = weight**2
+
+    membership = getBinMembership(df, all_bins)
+    membership_w = getBinMembership(df, all_bins, weights=weight)
+    membership_w2 = getBinMembership(df, all_bins, weights=weight2)
+
+    sumw = (membership.T @ membership_w).toarray()
+    sumw2 = (membership.T @ membership_w2).toarray()
+
+    return sumw, sumw2
+
+
+def getLambdas(cooc):
+    """Returns rates of the bivariate Poisson model from a co-occurrence matrix
+
+    - l1: In bin i but not in j
+    - l2: In bin j but not in i
+    - l3: In both bin i and j
+    """
+    # Diagonal is the sum of weights in bin i
+    diag = np.diag(cooc)
+
+    l3 = cooc.copy()
+    l1 = diag[:, np.newaxis] - l3
+    l2 = l1.T.copy()
+
+    return l1, l2, l3
+
+
+def getCorr(cooc_sumw, veto_negative_rates=False):
+    """Returns correlation matrix and rates from the co-occurrence matrix"""
+    l1_mat, l2_mat, l3_mat = getLambdas(cooc_sumw)
+
+    cnt_neg1 = np.count_nonzero(l1_mat < 0)
+    cnt_neg2 = np.count_nonzero(l2_mat < 0)
+    cnt_neg3 = np.count_nonzero(l3_mat < 0)
+
+    if veto_negative_rates:
+        # Set negative rates to 0
+        print(f"Setting {cnt_neg1} negative lambda1's to 0...")
+        l1_mat[l1_mat < 0] = 0.0
+        print(f"Setting {cnt_neg2} negative lambda2's to 0...")
+        l2_mat[l2_mat < 0] = 0.0
+        print(f"Setting {cnt_neg3} negative lambda3's to 0...")
+        l3_mat[l3_mat < 0] = 0.0
+    else:
+        print("Not vetoing negative rates")
+        print(f"Negative lambda 1's: {cnt_neg1}")
+        print(f"Negative lambda 2's: {cnt_neg2}")
+        print(f"Negative lambda 3's: {cnt_neg3}")
+
+    corr_mat = l3_mat / np.sqrt((l1_mat + l3_mat) * (l2_mat + l3_mat))
+
+    return corr_mat, l1_mat, l2_mat, l3_mat
+
+
+def writeCorr(filename, all_bins, cooc_sumw, veto_negative_rates=False):
+    corr_mat, l1_mat, l2_mat, l3_mat = getCorr(cooc_sumw, veto_negative_rates)
+
+    with h5py.File(filename, "w") as fout:
+        fout.create_dataset("bin_labels", data=np.array(all_bins, dtype=int))
+        fout.create_dataset("corr", data=corr_mat)
+        fout.create_dataset("l1", data=l1_mat)
+        fout.create_dataset("l2", data=l2_mat)
+        fout.create_dataset("l3", data=l3_mat)
+
+
+def getSampleScales(samples, norm_factors):
+    """Returns scale factor per sample
+
+    Keys of `norm_factors` are either names of normalization factors
+    (see `normFactorSamples`) or sample names.
+    """
+    scales = {sample: 1.0 for sample in samples}
+    for name, value in norm_factors.items():
+        if name not in normFactorSamples and name not in scales:
+            raise RuntimeError(f"Unknown sample or normalization factor: {name}")
+
+        for sample in normFactorSamples.get(name, [name]):
+            if sample in scales:
+                scales[sample] = value
+
+    return scales
+
+
+def combineSamples(cooc_sumw, cooc_sumw2, scales):
+    """Returns co-occurrence matrices of the sum of scaled samples"""
+    samples = sorted(cooc_sumw)
+
+    sumw = sum(scales[sample] * cooc_sumw[sample] for sample in samples)
+    sumw2 = sum(scales[sample]**2 * cooc_sumw2[sample] for sample in samples)
+
+    return sumw, sumw2
+
+
+# Partial sums per sample (e.g. from one shard of the dataframe) that
+# can be merged by simple addition. Weights are not scaled so that the
+# normalization factors can be changed without rescanning the events.
+#
+# The provenance records the input (`source`: file, key and number of
+# rows), the mass points and the shards (row range and samples, `None`
+# for all samples) that were summed, so that only partial sums of
+# disjoint shards of the same input are merged.
+partialVersion = 1
+
+
+def getProvenance(source, start, stop, samples):
+    """Returns provenance of the partial sums of a single shard"""
+    start, stop, _ = slice(start, stop).indices(source["nrows"])
+    return {
+        "source": source,
+        "masses": list(masspoints),
+        "shards": [{"start": start, "stop": stop,
+                    "samples": sorted(samples) if samples else None}],
+    }
+
+
+def writePartial(filename, all_bins, cooc_sumw, cooc_sumw2, provenance):
+    samples = sorted(cooc_sumw)
+    provenance = json.dumps(provenance, sort_keys=True)
+
+    with h5py.File(filename, "w") as fout:
+        fout.attrs["version"] = partialVersion
+        fout.attrs["provenance"] = provenance
+        fout.create_dataset("bin_labels", data=np.array(all_bins, dtype=int))
+        fout.create_dataset("samples", data=np.array(samples, dtype="S"))
+        fout.create_dataset("cooc_sumw", data=np.array([cooc_sumw[s] for s in samples]))
+        fout.create_dataset("cooc_sumw2", data=np.array([cooc_sumw2[s] for s in samples]))
+
+
+def readPartial(filename):
+    with h5py.File(filename, "r") as fin:
+        version = fin.attrs.get("version")
+        if version != partialVersion:
+            raise RuntimeError(f"Unsupported version of partial sums {filename}: {version}")
+
+        provenance = json.loads(fin.attrs["provenance"])
+        bin_labels = np.array(fin.get("bin_labels"))
+        samples = [s.decode() for s in fin.get("samples")]
+        sumw = np.array(fin.get("cooc_sumw"))
+        sumw2 = np.array(fin.get("cooc_sumw2"))
+
+    cooc_sumw = {sample: sumw[i] for i, sample in enumerate(samples)}
+    cooc_sumw2 = {sample: sumw2[i] for i, sample in enumerate(samples)}
+
+    return bin_labels, cooc_sumw, cooc_sumw2, provenance
+
+
+def _shardsOverlap(a, b):
+    if max(a["start"], b["start"]) >= min(a["stop"], b["stop"]):
+        return False
+
+    if a["samples"] is None or b["samples"] is None:
+        return True
+
+    return bool(set(a["samples"]) & set(b["samples"]))
+
+
+def mergeProvenance(provenances, filenames):
+    """Returns provenance of the sum of partial sums
+
+    Raises if the partial sums are from different inputs / mass points or
+    if shards overlap (e.g. the same partial sums given twice).
+    """
+    first = provenances[0]
+    shards = []
+    for provenance, fn in zip(provenances, filenames):
+        if provenance["source"] != first["source"]:
+            raise RuntimeError(f"Partial sums of {fn} and {filenames[0]} are from different "
+                               f"inputs: {provenance['source']} and {first['source']}")
+
+        if provenance["masses"] != first["masses"]:
+            raise RuntimeError(f"Mass points of {fn} and {filenames[0]} do not agree")
+
+        for shard in provenance["shards"]:
+            for other, other_fn in shards:
+                if _shardsOverlap(shard, other):
+                    raise RuntimeError(f"Overlapping shards in {fn} and {other_fn}: "
+                                       f"{shard} and {other}")
+
+            shards.append((shard, fn))
+
+    return {
+        "source": first["source"],
+        "masses": first["masses"],
+        "shards": sorted((shard for shard, _ in shards),
+                         key=lambda x: (x["start"], x["stop"], x["samples"] or [])),
+    }
+
+
+def embedCooccurrence(cooc, bin_labels, all_bins):
+    """Returns (bin x bin) matrix of `bin_labels` embedded into `all_bins`"""
+    index = {label: i for i, label in enumerate(all_bins)}
+    idx = np.array([index[(int(mass), int(ibin))] for mass, ibin in bin_labels], dtype=np.int64)
+
+    embedded = np.zeros((len(all_bins), len(all_bins)), dtype=cooc.dtype)
+    embedded[np.ix_(idx, idx)] = cooc
+
+    return embedded
+
+
+def mergePartials(filenames):
+    """Returns the sum of partial sums on the union of their bin labels
+
+    Only partial sums of disjoint shards of the same input are merged
+    (see `mergeProvenance`).
+    """
+    partials = [readPartial(fn) for fn in filenames]
+    provenance = mergeProvenance([partial[3] for partial in partials], filenames)
+
+    unique_bins = {}
+    for bin_labels, _, _, _ in partials:
+        for mass, ibin in bin_labels:
+            unique_bins.setdefault(int(mass), set()).add(int(ibin))
+
+    all_bins = getBinLabels(unique_bins)
+
+    cooc_sumw = {}
+    cooc_sumw2 = {}
+    for bin_labels, other_sumw, other_sumw2, _ in partials:
+        # Shards may contain different samples
+        for sample in other_sumw:
+            sumw = embedCooccurrence(other_sumw[sample], bin_labels, all_bins)
+            sumw2 = embedCooccurrence(other_sumw2[sample], bin_labels, all_bins)
+
+            if sample in cooc_sumw:
+                cooc_sumw[sample] += sumw
+                cooc_sumw2[sample] += sumw2
+            else:
+                cooc_sumw[sample] = sumw
+                cooc_sumw2[sample] = sumw2
+
+    return all_bins, cooc_sumw, cooc_sumw2, provenance
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+from tqdm import tqdm
+import argparse
+import h5py
+import numpy as np
+
+from cell_utils import loadCells
+from corr_utils import getBinLabels, getBinMembership
+from corr_utils import getSampleScales, updateUniqueBins
+from parallel_utils import imapBlocks, toyBlocks, workerState
+from toy_utils import RunningMoments, appendRows, createRowDataset, getExpectedRates
+from utils import defaultNormFactors, masspoints
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("infile_cells")
+parser.add_argument("infile_asimov")
+parser.add_argument("-c", "--channel", choices=["Hadhad", "SLT", "LTT"], required=True)
+parser.add_argument("-o", "--outfile", default=None)
+parser.add_argument("--ntoys", type=int, default=500000)
+parser.add_argument("--batch-size", type=int, default=1000)
+parser.add_argument("-j", "--jobs", type=int, default=1)
+parser.add_argument("--max-iterations", type=int, default=1000)
+parser.add_argument("--tolerance", type=float, default=1e-10)
+args = parser.parse_args()
+
+
+# Use different seed for different channels for reproducibility and
+# independent RVS
+if args.channel == "Hadhad":
+    seed = 7213498712
+elif args.channel == "SLT":
+    seed = 5023874112
+elif args.channel == "LTT":
+    seed = 1098234751
+
+
+# Cells with normalization factors applied (consistent with
+# makeCorr.py). Samples are merged since only the bin signature
+# matters for the generation.
+cells = loadCells(args.infile_cells)
+cells = cells.loc[cells["sample"] != "data"].copy()
+
+scales = getSampleScales(cells["sample"].cat.categories, defaultNormFactors)
+cells["rate"] = cells["weight"] * cells["sample"].map(scales).astype(np.float64)
+
+bin_columns = [f"PNN{mass}Bin" for mass in masspoints]
+cells = cells.groupby(bin_columns, sort=True)["rate"].sum().reset_index()
+
+# Cells with negative total weight cannot contribute
+print(f"Number of cells: {len(cells)}")
+print(f"Cells with negative rates: {np.count_nonzero(cells['rate'] < 0)}")
+cells["rate"] = cells["rate"].clip(lower=0.0)
+
+
+unique_bins = {}
+updateUniqueBins(unique_bins, cells)
+bin_labels = np.array(getBinLabels(unique_bins), dtype=int)
+nbins = len(bin_labels)
+
+mu = getExpectedRates(args.infile_asimov, args.channel, bin_labels)
+
+# (cell x bin) membership matrix
+membership = getBinMembership(cells, bin_labels).tocsc()
+
+
+# Rescale cell rates such that the expected yields of all bins agree
+# with the Asimov dataset (iterative proportional fitting, one mass
+# point at a time)
+rate = cells["rate"].to_numpy()
+bin_mass = bin_labels[:, 0]
+
+# Can only be matched exactly if all mass points have the same total
+totals = np.array([mu[bin_mass == mass].sum() for mass in masspoints])
+print(f"Maximum relative spread of total Asimov yield: {totals.max() / totals.min() - 1:.2e}")
+
+# Bins without expected events only enter through their (vanishing) yields
+nonzero = mu > 0
+
+
+def getMaxDeviation(rate):
+    """Returns maximum relative deviation of the expected yields from Asimov"""
+    yields = membership.T @ rate
+    return np.max(np.abs(yields[nonzero] - mu[nonzero]) / mu[nonzero], initial=0.0)
+
+
+iterations = 0
+max_dev = getMaxDeviation(rate)
+converged = max_dev < args.tolerance
+
+while not converged and iterations < args.max_iterations:
+    for mass in masspoints:
+        cols = np.flatnonzero(bin_mass == mass)
+        yields = membership[:, cols].T @ rate
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            factor = np.where(yields > 0, mu[cols] / yields, 0.0)
+
+        rate = rate * (membership[:, cols] @ factor)
+
+    iterations += 1
+    max_dev = getMaxDeviation(rate)
+    converged = max_dev < args.tolerance
+
+print(f"Iterations: {iterations}")
+print(f"Maximum relative deviation of expected yields from Asimov: {max_dev:.2e}")
+if not converged:
+    print(f"WARNING: Expected yields did not converge within {args.max_iterations} iterations "
+          f"(tolerance: {args.tolerance:.1e})")
+
+
+# Exact covariance of the superposition model
+membership = membership.tocsr()
+cov = (membership.T @ membership.multiply(rate[:, np.newaxis])).toarray()
+var = np.diag(cov)
+corr = cov / np.sqrt(var[:, np.newaxis] * var[np.newaxis, :])
+
+
+# Generate toys: independent Poisson counts per cell summed into bins
+fout = None
+dset = None
+if args.outfile:
+    fout = h5py.File(args.outfile, "w")
+    fout.create_dataset("bin_labels", data=bin_labels)
+    dset = createRowDataset(fout, "poisson_rvs", nbins, min(args.batch_size, 1024),
+                            compression="gzip", compression_opts=9)
+
+moments = RunningMoments(nbins)
+
+def generateBatch(start, stop, rng):
+    state = workerState()
+    rate, membership = state["rate"], state["membership"]
+
+    counts = rng.poisson(rate, size=(stop - start, len(rate)))
+    return np.asarray(membership.T @ counts.T, dtype=np.float64).T
+
+
+batches = imapBlocks(generateBatch, args.ntoys, args.batch_size, seed, jobs=args.jobs,
+                     state={"rate": rate, "membership": membership})
+
+for start, stop, rvs in tqdm(batches, total=len(toyBlocks(args.ntoys, args.batch_size))):
+    moments.update(rvs)
+
+    if dset is not None:
+        appendRows(dset, rvs)
+
+if fout is not None:
+    fout.close()
+
+
+# Check summary statistics to ensure that things worked alright
+sample_mu = moments.mean
+sample_var = moments.var()
+sample_corr = moments.corr()
+
+drel_mu = (sample_mu - mu) / mu
+drel_var = (sample_var - mu) / mu
+
+with np.printoptions(precision=3, suppress=True):
+    print("\nRelative error on mu:")
+    print(drel_mu)
+
+    print("\nRelative error on variance:")
+    print(drel_var)
+
+dcorr = np.abs(sample_corr - corr)
+print(f"Maximum error: {100 * np.max(dcorr):.2f} %")
+print(f"Mean absolute difference: {np.mean(100 * np.abs(dcorr)):.2f} %")
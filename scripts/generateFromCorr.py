@@ -1,12 +1,12 @@
 #!/usr/bin/env python
-from scipy import stats
 from tqdm import tqdm
 import argparse
 import h5py
 import numpy as np
-import uproot
 
-from utils import masspoints
+from parallel_utils import imapBlocks, toyBlocks, workerState
+from toy_utils import CorrelatedNormalSampler, PoissonQuantileTable, RunningMoments
+from toy_utils import appendRows, createRowDataset, getExpectedRates
 
 
 parser = argparse.ArgumentParser()
@@ -14,6 +14,11 @@ parser.add_argument("infile_corr")
 parser.add_argument("infile_asimov")
 parser.add_argument("-c", "--channel", choices=["Hadhad", "SLT", "LTT"], required=True)
 parser.add_argument("-o", "--outfile", default=None)
+parser.add_argument("--ntoys", type=int, default=500000)
+parser.add_argument("--batch-size", type=int, default=10000)
+parser.add_argument("-j", "--jobs", type=int, default=1)
+parser.add_argument("--factor-cache", default=None,
+                    help="File to cache the decomposition of the correlation matrix in")
 args = parser.parse_args()
 
 
@@ -26,46 +31,24 @@ elif args.channel == "SLT":
 elif args.channel == "LTT":
     seed = 9523609123
 
-rng = np.random.default_rng(seed)
-
 
 # Read correlation matrix
 with h5py.File(args.infile_corr, "r") as fin:
     bin_labels = np.array(fin.get("bin_labels"))
     corr = np.array(fin.get("corr"))
 
+# Decomposition of the correlation matrix (optionally cached)
+sampler = CorrelatedNormalSampler.fromFile(args.infile_corr, cache=args.factor_cache)
+
 
 # Read Asimov (for expected background)
-asimov_hists = {}
-with uproot.open(args.infile_asimov) as fin:
-    for mass in masspoints:
-        if args.channel == "Hadhad":
-            hname = f"obs_hh_m{mass}"
-        elif args.channel == "SLT":
-            hname = f"obs_lh_slt_m{mass}"
-        elif args.channel == "LTT":
-            hname = f"obs_lh_ltt_m{mass}"
-        else:
-            raise RuntimeError("Unknown channel")
-
-        asimov_hists[mass] = fin[hname].to_numpy()
-
-
-# Build vector of expected rates
-mu = []
-for mass, ibin in bin_labels:
-    hist, edges = asimov_hists[mass]
-    # Histograms loaded with uproot do not contain over / underflows
-    # but these are counted in bin_labels
-    mu.append(hist[ibin - 1])
-
-mu = np.array(mu)
+mu = getExpectedRates(args.infile_asimov, args.channel, bin_labels)
 
 # Shape of corr-matrix
 print(f"Shape of correlation matrix: {corr.shape}")
 
-# Rank of corr-matrix
-rank = np.linalg.matrix_rank(corr)
+# Rank of corr-matrix (eigenvalues above the tolerance of the sampler)
+rank = sampler.rank
 print(f"\nRank of correlation matrix: {rank}")
 
 # Dimension minus rank (i.e. the number of redundant dimensions)
@@ -76,35 +59,62 @@ corr_rmdiag = corr.copy()
 np.fill_diagonal(corr_rmdiag, 0.0)
 print(f"\nMaximum correlation of off-diagonal elements: {corr_rmdiag.max()}")
 
-# Diagonalize correlation matrix
-eigval, eigvec = np.linalg.eigh(corr)
+# Eigenvalues of correlation matrix
 with np.printoptions(precision=3, suppress=True):
-    print(f"\nEigenvalues: {eigval}")
+    print(f"\nEigenvalues: {sampler.eigval}")
+
+# Lookup tables of the Poisson quantile function
+quantiles = PoissonQuantileTable(mu)
+
+# Output file (toys are written batch by batch)
+fout = None
+dset = None
+if args.outfile:
+    fout = h5py.File(args.outfile, "w")
+    fout.create_dataset("bin_labels", data=bin_labels)
+    dset = createRowDataset(fout, "poisson_rvs", len(mu), min(args.batch_size, 1024),
+                            compression="gzip", compression_opts=9)
+
+# Summary statistics accumulated over batches
+moments_norm = RunningMoments(len(mu))
+moments_pois = RunningMoments(len(mu))
+
+def generateBatch(start, stop, rng):
+    state = workerState()
+
+    # Multivariate normal RVS
+    rnd = state["sampler"].rvs(stop - start, rng)
+
+    # Transform multivariate normal to Poisson
+    rvs = state["quantiles"].fromNormal(rnd)
 
-eigval[eigval < 1e-12] = 0.0
+    return rnd, rvs
 
-# Multivariate normal RVS
-rvs = []
-for batch in tqdm(range(50)):
-    rnd = stats.norm.rvs(size=(10000, len(eigval)), random_state=rng)
-    rnd *= np.sqrt(eigval)
-    # Beware: crazy broadcasting
-    rnd = (rnd[:, :, np.newaxis] * eigvec.T[np.newaxis]).sum(axis=1)
-    rvs.append(rnd)
 
-rvs = np.concatenate(rvs)
-print(rvs.shape)
+batches = imapBlocks(generateBatch, args.ntoys, args.batch_size, seed, jobs=args.jobs,
+                     state={"sampler": sampler, "quantiles": quantiles})
 
-sample_corr = np.corrcoef(rnd.T)
+for start, stop, (rnd, rvs) in tqdm(batches, total=len(toyBlocks(args.ntoys, args.batch_size))):
+    moments_norm.update(rnd)
+    moments_pois.update(rvs)
+
+    if dset is not None:
+        appendRows(dset, rvs)
+
+if fout is not None:
+    fout.close()
+
+
+sample_corr = moments_norm.corr()
 with np.printoptions(precision=3, suppress=True):
     print("Correlation matrix of RVS:")
     print(sample_corr)
 
     print("\nMean of RVS:")
-    print(rvs.mean(axis=0))
+    print(moments_norm.mean)
 
     print("\nStd of RVS:")
-    print(rvs.std(axis=0))
+    print(moments_norm.std())
 
 # Error
 dcorr = np.abs(sample_corr - corr)
@@ -112,14 +122,9 @@ print(f"Maximum error: {100 * np.max(dcorr):.2f} %")
 print(f"Mean absolute error: {np.mean(100 * np.abs(dcorr)):.2f} %")
 
 
-# Transform multivariate normal to Poisson
-rvs = stats.norm.cdf(rvs)
-rvs = stats.poisson.ppf(rvs, mu=mu)
-
-
 # Check summary statistics to ensure that things worked alright
-sample_mu = rvs.mean(axis=0)
-sample_var = rvs.var(axis=0)
+sample_mu = moments_pois.mean
+sample_var = moments_pois.var()
 
 drel_mu = (sample_mu - mu) / mu
 drel_var = (sample_var - mu) / mu
@@ -130,12 +135,7 @@ print(drel_mu)
 print("\nRelative error on variance:")
 print(drel_var)
 
-sample_corr = np.corrcoef(rvs.T)
+sample_corr = moments_pois.corr()
 dcorr = np.abs(sample_corr - corr)
 print(f"Maximum error: {100 * np.max(dcorr):.2f} %")
 print(f"Mean absolute difference: {np.mean(100 * np.abs(dcorr)):.2f} %")
-
-if args.outfile:
-    with h5py.File(args.outfile, "w") as fout:
-        fout.create_dataset("bin_labels", data=bin_labels)
-        fout.create_dataset("poisson_rvs", data=rvs, compression="gzip", compression_opts=9)
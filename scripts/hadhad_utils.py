@@ -1,36 +1,24 @@
-import numpy as np
 import pandas as pd
-import pickle
-import uproot
 
+from ntuple_utils import iterateTree
 from utils import masspoints
 
 
-# Bin edges before rebinning (i.e. original histograms)
-edgesHadhadPreRebin = np.linspace(0, 1, 1001, dtype=np.float64)
-
-
-# Bin edges after rebinning
-with open("edges_hadhad.pkl", "rb") as f:
-    edgesHadhad = pickle.load(f)
-
-
-def getHadhadDf(filename, treename):
+def getHadhadDf(filename, treename, step_size="100 MB"):
     variables = ["weight", "same_sign", "n_btag", "is_sr"]
     variables += ["b0_truth_match", "b1_truth_match", "mc_channel", "run_number"]
     variables += [f"PNN{mass}" for mass in masspoints]
 
-    with uproot.open(filename) as f:
-        t = f[treename]
-        df = t.arrays(variables, library="pd")
+    # Apply selection chunk by chunk
+    dfs = []
+    for chunk, _, _ in iterateTree(filename, treename, variables, step_size, "pd"):
+        sel = (~chunk["same_sign"]) & (chunk["n_btag"] == 2)
+        if treename != "Fake":
+            sel = sel & chunk["is_sr"]
 
-    # Apply selection
-    sel = (~df["same_sign"]) & (df["n_btag"] == 2)
-    if treename != "Fake":
-        sel = sel & df["is_sr"]
+        dfs.append(chunk.loc[sel].drop(columns=["same_sign", "n_btag", "is_sr"]))
 
-    df = df.loc[sel]
-    df.drop(columns=["same_sign", "n_btag", "is_sr"], inplace=True)
+    df = pd.concat(dfs)
 
     # Sample (re-)naming
     name_mapping = {
@@ -1,23 +1,37 @@
 #!/usr/bin/env python
 import argparse
+import json
 import numpy as np
-from scipy import stats
+import os
+import tempfile
 from tqdm import tqdm
 
+from parallel_utils import imapBlocks, toyBlocks, workerState
+from toy_utils import truncatedNormal
+from tree_utils import writeGlobsTree
+
 parser = argparse.ArgumentParser()
 parser.add_argument("workspaces", nargs="+")
 parser.add_argument("-o", "--outfile", default="alphas.root")
+parser.add_argument("--ntoys", type=int, default=20000)
+parser.add_argument("--block-size", type=int, default=2000,
+                    help="Number of toys drawn at once (blocks are distributed over the jobs)")
+parser.add_argument("-j", "--jobs", type=int, default=1)
+parser.add_argument("--basket-size", type=int, default=10000,
+                    help="Number of entries per basket of the output tree")
+parser.add_argument("--compression", default="zlib:1",
+                    help="Compression of the output file (e.g. zlib:1, lzma:9, none)")
+parser.add_argument("--cache", default="alpha_globs_cache.json",
+                    help="Cache of the names of global observables per workspace "
+                    "(empty string to disable)")
 args = parser.parse_args()
 
-rng = np.random.default_rng(64782119739)
-
-trunc_norm = stats.truncnorm(-5, 5)
-
-
-import ROOT as R
-R.gROOT.SetBatch(True)
 
 def get_globs(filename):
+    # Only needed if a workspace is not cached
+    import ROOT as R
+    R.gROOT.SetBatch(True)
+
     f = R.TFile.Open(filename)
 
     w = f.Get("combined")
@@ -35,9 +49,39 @@ def get_globs(filename):
     return globs
 
 
+def cache_key(filename):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+# Names of global observables per workspace are cached by path and
+# invalidated if the size or modification time of the file changes
+cache = {}
+if args.cache and os.path.exists(args.cache):
+    with open(args.cache) as fin:
+        cache = json.load(fin)
+
 all_globs = set()
 for fn in args.workspaces:
-    all_globs = all_globs | get_globs(fn)
+    path = os.path.abspath(fn)
+    key = cache_key(path)
+
+    entry = cache.get(path)
+    if entry is None or entry["key"] != key:
+        print(f"Reading global observables from {fn}")
+        entry = {"key": key, "globs": sorted(get_globs(fn))}
+        cache[path] = entry
+
+    all_globs = all_globs | set(entry["globs"])
+
+if args.cache:
+    # Replace atomically in case of concurrent runs (unique temporary file
+    # per run in the same directory)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(args.cache)),
+                                     suffix=".tmp", delete=False) as fout:
+        json.dump(cache, fout, indent=1, sort_keys=True)
+
+    os.replace(fout.name, args.cache)
 
 
 # Filter global observables
@@ -56,26 +100,24 @@ for fn in args.workspaces:
 
 # all_globs = all_globs_filtered
 
-for glob in sorted(all_globs):
+# Branches in alphabetical order
+all_globs = sorted(all_globs)
+for glob in all_globs:
     print(glob)
 
 
-f = R.TFile.Open(args.outfile, "RECREATE")
-tree = R.TTree("globs_alphas", "globs_alphas")
-tree.SetDirectory(f)
-
-arrays = {}
-branches = {}
-for glob in sorted(all_globs):
-    arrays[glob] = np.zeros(1, dtype=np.float32)
-    branches[glob] = tree.Branch(glob, arrays[glob], f"{glob}/F")
+def drawBlock(start, stop, rng):
+    nglobs = workerState()["nglobs"]
+    return truncatedNormal(rng, (stop - start, nglobs), 5)
 
 
-for i in tqdm(range(20000)):
-    for glob in sorted(all_globs):
-        arrays[glob][0] = trunc_norm.rvs(random_state=rng)
+blocks = imapBlocks(drawBlock, args.ntoys, args.block_size, 64782119739,
+                    jobs=args.jobs, state={"nglobs": len(all_globs)})
 
-    tree.Fill()
+values = np.zeros((args.ntoys, len(all_globs)), dtype=np.float32)
+for start, stop, block in tqdm(blocks, total=len(toyBlocks(args.ntoys, args.block_size))):
+    values[start:stop] = block
 
-tree.Write()
-f.Close()
+writeGlobsTree(args.outfile, "globs_alphas",
+               {glob: values[:, i] for i, glob in enumerate(all_globs)},
+               basket_size=args.basket_size, compression=args.compression)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import contextlib
+import multiprocessing
+import os
+
+from asimov_utils import AsimovCache, makeAsimovHists, writeAsimovHists
+from utils import masspoints
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("workspaces", help="Path of the workspaces with placeholder {mass}, "
+                        "e.g. 'workspaces/{mass}.root'")
+    parser.add_argument("-o", "--outfile", required=True)
+    parser.add_argument("-m", "--masses", type=int, nargs="+", default=masspoints)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("--cache-dir", default=None,
+                        help="Cache of the histograms of unchanged workspaces "
+                        "(default: asimov_cache next to the output file)")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    import ROOT as R
+    R.gROOT.SetBatch(True)
+
+    filenames = {mass: args.workspaces.format(mass=mass) for mass in args.masses}
+
+    cache = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(args.outfile), "asimov_cache")
+
+        cache = AsimovCache(cache_dir)
+        keys = {mass: cache.key(filenames[mass], mass) for mass in args.masses}
+        missing = [mass for mass in args.masses if not cache.has(keys[mass])]
+    else:
+        missing = list(args.masses)
+
+    print(f"Processing {len(missing)} of {len(args.masses)} workspaces "
+          f"({len(args.masses) - len(missing)} cached)")
+
+    fout = R.TFile.Open(args.outfile, "RECREATE")
+
+    with contextlib.ExitStack() as stack:
+        if args.jobs == 1:
+            mapper = map
+        else:
+            # RooFit is not fork-safe, every worker starts its own
+            # interpreter and loads ROOT once for all of its workspaces
+            context = multiprocessing.get_context("spawn")
+            pool = stack.enter_context(
+                ProcessPoolExecutor(max_workers=args.jobs, mp_context=context))
+            mapper = pool.map
+
+        # Results in the order of `missing`
+        results = mapper(makeAsimovHists, [filenames[mass] for mass in missing], missing)
+
+        for mass in args.masses:
+            if mass in missing:
+                hists = next(results)
+                if cache:
+                    cache.put(keys[mass], hists)
+            else:
+                hists = cache.get(keys[mass])
+
+            print(f"Writing mX = {mass} GeV")
+            writeAsimovHists(fout, hists)
+
+    fout.Close()
+
+
+# Guard needed since spawned workers import this module
+if __name__ == "__main__":
+    main()
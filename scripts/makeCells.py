@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+from tqdm import tqdm
+import argparse
+
+from cell_utils import cellsFilename, getCells, mergeCells, writeCells
+from column_utils import readDataframe
+from utils import masspoints
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("dataframe")
+parser.add_argument("-o", "--outfile", default=None,
+                    help="Default: next to the dataframe (*_cells.h5)")
+parser.add_argument("--chunksize", type=int, default=None,
+                    help="Read the dataframe in chunks of this many rows")
+args = parser.parse_args()
+
+
+columns = ["weight", "sample"] + [f"PNN{mass}Bin" for mass in masspoints]
+
+if args.chunksize is None:
+    cells = getCells(readDataframe(args.dataframe, columns))
+else:
+    cells = []
+    for chunk in tqdm(readDataframe(args.dataframe, columns, chunksize=args.chunksize)):
+        cells.append(getCells(chunk))
+        # Keep memory bounded
+        if len(cells) > 10:
+            cells = [mergeCells(cells)]
+
+    cells = mergeCells(cells)
+
+print(f"Number of events: {cells['count'].sum()}")
+print(f"Number of cells: {len(cells)}")
+print(cells.groupby("sample", observed=True)["count"].agg(Cells="count", Entries="sum"))
+
+outfile = args.outfile if args.outfile else cellsFilename(args.dataframe)
+writeCells(outfile, cells)
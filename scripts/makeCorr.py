@@ -1,105 +1,136 @@
 #!/usr/bin/env python
 from tqdm import tqdm
 import argparse
-import h5py
 import numpy as np
-import pandas as pd
 
-from utils import masspoints
+from cell_utils import describeCells, loadCells
+from column_utils import describeDataframe, readDataframe
+from corr_utils import getBinLabels, getCooccurrence, updateUniqueBins
+from corr_utils import combineSamples, getSampleScales
+from corr_utils import getProvenance, writeCorr, writePartial
+from utils import defaultNormFactors, masspoints
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("dataframe")
 parser.add_argument("-o", "--outfile", required=True)
 parser.add_argument("--veto-negative-rates", action="store_true")
+parser.add_argument("--chunksize", type=int, default=None,
+                    help="Read the dataframe in chunks of this many rows")
+parser.add_argument("--start", type=int, default=None,
+                    help="First row of the dataframe to process (shard)")
+parser.add_argument("--stop", type=int, default=None,
+                    help="Stop processing before this row (shard)")
+parser.add_argument("--samples", nargs="+", default=None,
+                    help="Only process these samples (shard)")
+parser.add_argument("--cells", action="store_true",
+                    help="Input is a cell index from makeCells.py instead of a dataframe")
+parser.add_argument("--partial", action="store_true",
+                    help="Write partial sums to be combined with mergeCorr.py")
 args = parser.parse_args()
 
 
-df = pd.read_hdf(args.dataframe)
-df["weight"] = df["weight"].astype(np.float64)
-df["weightSquared"] = df["weight"]**2
+# Columns needed for the bin labels / correlation calculation
+bin_columns = ["sample"] + [f"PNN{mass}Bin" for mass in masspoints]
+columns = ["weight"] + bin_columns
 
-# Drop data
-df = df.loc[df["sample"] != "data"]
-if "data" in df["sample"].cat.categories:
-    df["sample"] = df["sample"].cat.remove_categories(["data"])
 
-# Apply scale factors
-zhf_scale = 1.35
-ttbar_scale = 0.97
+def prepareDataframe(df):
+    # Drop data
+    df = df.loc[df["sample"] != "data"]
+    if "data" in df["sample"].cat.categories:
+        df["sample"] = df["sample"].cat.remove_categories(["data"])
 
-# Z+HF
-mask_zhf = \
-    (df["sample"] == "Zttbb") | (df["sample"] == "Zttbc") | (df["sample"] == "Zttcc") \
-    | (df["sample"] == "Zbb") | (df["sample"] == "Zbc") | (df["sample"] == "Zcc")
-df.loc[mask_zhf, "weight"] *= zhf_scale
+    if "weight" not in df.columns:
+        return df
 
-# ttbar
-mask_ttbar = (df["sample"] == "ttbar") | (df["sample"] == "ttbarFakesMC")
-df.loc[mask_ttbar, "weight"] *= ttbar_scale
+    df["weight"] = df["weight"].astype(np.float64)
 
-print("Yield after scale factors:")
-print(df.groupby("sample")["weight"].agg(Entries="count", Integral="sum"))
+    return df
 
 
-# List of all bins for channel
-all_bins = []
-for mass in sorted(masspoints):
-    unique_bins = sorted(df[f"PNN{mass}Bin"].unique())
-    for ibin in unique_bins:
-        all_bins.append((mass, ibin))
+def readChunks(columns, start=None, stop=None):
+    """Yields the dataframe in chunks of rows (or in one piece)"""
+    if args.cells:
+        chunks = [loadCells(args.dataframe).iloc[start:stop]]
+    elif args.chunksize is None:
+        chunks = [readDataframe(args.dataframe, columns, start, stop)]
+    else:
+        chunks = readDataframe(args.dataframe, columns, start, stop, chunksize=args.chunksize)
 
-# Matrices for correlation calculation
-nbins = len(all_bins)
-
-l1_mat = np.zeros((nbins, nbins), dtype=np.float64)
-l2_mat = np.zeros((nbins, nbins), dtype=np.float64)
-l3_mat = np.zeros((nbins, nbins), dtype=np.float64)
-
-l1_sumw2_mat = np.zeros((nbins, nbins), dtype=np.float64)
-l2_sumw2_mat = np.zeros((nbins, nbins), dtype=np.float64)
-l3_sumw2_mat = np.zeros((nbins, nbins), dtype=np.float64)
-
-for i, (mass_i, ibin_i) in tqdm(enumerate(all_bins), total=nbins):
-    in_i = df[f"PNN{mass_i}Bin"] == ibin_i
+    for chunk in chunks:
+        yield prepareDataframe(chunk)
 
-    for j, (mass_j, ibin_j) in enumerate(all_bins):
-        in_j = df[f"PNN{mass_j}Bin"] == ibin_j
 
-        l1_mat[i, j] = df.loc[in_i & ~in_j, "weight"].sum() # In bin i but not in j
-        l2_mat[i, j] = df.loc[~in_i & in_j, "weight"].sum() # In bin j but not in i
-        l3_mat[i, j] = df.loc[in_i & in_j, "weight"].sum()  # In both bin i and j
+def selectSamples(df):
+    if not args.samples:
+        return df
 
-        l1_sumw2_mat[i, j] = df.loc[in_i & ~in_j, "weightSquared"].sum() # In bin i but not in j
-        l2_sumw2_mat[i, j] = df.loc[~in_i & in_j, "weightSquared"].sum() # In bin j but not in i
-        l3_sumw2_mat[i, j] = df.loc[in_i & in_j, "weightSquared"].sum()  # In both bin i and j
+    unknown = set(args.samples) - set(df["sample"].cat.categories)
+    if unknown:
+        raise RuntimeError(f"Unknown samples: {', '.join(sorted(unknown))}")
 
+    return df.loc[df["sample"].isin(args.samples)]
 
-cnt_neg1 = np.count_nonzero(l1_mat < 0)
-cnt_neg2 = np.count_nonzero(l2_mat < 0)
-cnt_neg3 = np.count_nonzero(l3_mat < 0)
 
-if args.veto_negative_rates:
-    # Set negative rates to 0
-    print(f"Setting {cnt_neg1} negative lambda1's to 0...")
-    l1_mat[l1_mat < 0] = 0.0
-    print(f"Setting {cnt_neg2} negative lambda2's to 0...")
-    l2_mat[l2_mat < 0] = 0.0
-    print(f"Setting {cnt_neg3} negative lambda3's to 0...")
-    l3_mat[l3_mat < 0] = 0.0
+# Only the rows of the shard are read. Without chunks the shard is read
+# once for both passes.
+if args.chunksize is None:
+    label_chunks = cooc_chunks = [selectSamples(df) for df in
+                                  readChunks(columns, start=args.start, stop=args.stop)]
 else:
-    print("Not vetoing negative rates")
-    print(f"Negative lambda 1's: {cnt_neg1}")
-    print(f"Negative lambda 2's: {cnt_neg2}")
-    print(f"Negative lambda 3's: {cnt_neg3}")
-
-
-corr_mat = l3_mat / np.sqrt((l1_mat + l3_mat) * (l2_mat + l3_mat))
+    label_chunks = (selectSamples(df) for df in
+                    readChunks(bin_columns, start=args.start, stop=args.stop))
+    cooc_chunks = (selectSamples(df) for df in
+                   readChunks(columns, start=args.start, stop=args.stop))
+
+# List of all bins of the shard (first pass). Partial sums of shards with
+# different bins are combined on the union of the bins by mergeCorr.py.
+unique_bins = {}
+for df in tqdm(label_chunks, desc="Bin labels", disable=args.chunksize is None):
+    updateUniqueBins(unique_bins, df)
+
+all_bins = getBinLabels(unique_bins)
+nbins = len(all_bins)
 
-# Save to HDF5
-with h5py.File(args.outfile, "w") as fout:
-    fout.create_dataset("bin_labels", data=np.array(all_bins, dtype=int))
-    fout.create_dataset("corr", data=corr_mat)
-    fout.create_dataset("l1", data=l1_mat)
-    fout.create_dataset("l2", data=l2_mat)
-    fout.create_dataset("l3", data=l3_mat)
+# Sum of weights / weights^2 of events in both bin i and j per sample
+# (single pass using a sparse event-to-bin membership matrix,
+# accumulated over chunks)
+print(f"Calculating co-occurrence matrices for {nbins} bins...")
+cooc_sumw = {}
+cooc_sumw2 = {}
+
+yields = None
+for df in tqdm(cooc_chunks, desc="Co-occurrence", disable=args.chunksize is None):
+    for sample, df_sample in df.groupby("sample"):
+        if len(df_sample) == 0:
+            continue
+
+        sample_sumw, sample_sumw2 = getCooccurrence(df_sample, all_bins)
+
+        if sample in cooc_sumw:
+            cooc_sumw[sample] += sample_sumw
+            cooc_sumw2[sample] += sample_sumw2
+        else:
+            cooc_sumw[sample] = sample_sumw
+            cooc_sumw2[sample] = sample_sumw2
+
+    if args.cells:
+        chunk_yields = df.groupby("sample").agg(Entries=("count", "sum"), Integral=("weight", "sum"))
+    else:
+        chunk_yields = df.groupby("sample")["weight"].agg(Entries="count", Integral="sum")
+    yields = chunk_yields if yields is None else yields.add(chunk_yields, fill_value=0)
+
+scales = getSampleScales(cooc_sumw, defaultNormFactors)
+yields["Scale"] = [scales.get(sample, 1.0) for sample in yields.index]
+
+print("Yield before scale factors:")
+print(yields)
+
+if args.partial:
+    source = describeCells(args.dataframe) if args.cells else describeDataframe(args.dataframe)
+    provenance = getProvenance(source, args.start, args.stop, args.samples)
+    writePartial(args.outfile, all_bins, cooc_sumw, cooc_sumw2, provenance)
+else:
+    sumw, sumw2 = combineSamples(cooc_sumw, cooc_sumw2, scales)
+    writeCorr(args.outfile, all_bins, sumw, args.veto_negative_rates)
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
-from scipy import stats
 from tqdm import tqdm
 import argparse
 import numpy as np
 import os
-import pandas as pd
+import time
 
+from cell_utils import getCells
+from column_utils import readDataframe
+from corr_utils import getBinMembership
+from parallel_utils import SharedArrays, imapBlocks, toyBlocks, workerState
+from tree_utils import writeGlobsTree
 from utils import masspoints
 
 import ROOT as R
@@ -17,6 +21,21 @@ parser.add_argument("dataframe")
 parser.add_argument("asimov")
 parser.add_argument("-c", "--channel", choices=["Hadhad", "SLT", "LTT"], required=True)
 parser.add_argument("-o", "--outdir", default="")
+parser.add_argument("--ntoys", type=int, default=20000)
+parser.add_argument("--block-size", type=int, default=20,
+                    help="Memory usage scales with block size x number of events")
+parser.add_argument("-j", "--jobs", type=int, default=1)
+parser.add_argument("--basket-size", type=int, default=10000,
+                    help="Number of entries per basket of the output trees")
+parser.add_argument("--compression", default="zlib:1",
+                    help="Compression of the output files (e.g. zlib:1, lzma:9, none)")
+parser.add_argument("--approx", action="store_true",
+                    help="Use normal approximation for large groups of events with "
+                    "identical bins for all mass points")
+parser.add_argument("--approx-min-events", type=int, default=100,
+                    help="Minimum number of events of approximated groups")
+parser.add_argument("--approx-min-tau", type=float, default=50.,
+                    help="Minimum effective MC statistics of approximated groups")
 args = parser.parse_args()
 
 
@@ -29,10 +48,8 @@ elif args.channel == "SLT":
 elif args.channel == "LTT":
     seed = 6923601232
 
-rng = np.random.default_rng(seed)
 
-
-df = pd.read_hdf(args.dataframe)
+df = readDataframe(args.dataframe)
 df["weight"] = df["weight"].astype(np.float64)
 df["weightSquared"] = df["weight"]**2
 
@@ -96,53 +113,114 @@ for mass in masspoints:
     sf[mass] = tau_ws[mass] / sumw[mass]
 
 # Calculate random global observables
-# This is relatively slow but should be good enough for now
-globs = {}
-for i in tqdm(range(20000)):
-    pois_weight = stats.poisson.rvs(mu=1, size=len(df), random_state=rng)
-    df["toy_weight"] = pois_weight * df["weight"]
+#
+# Bootstrap with Poisson(1) weights per event for a block of toys at
+# once. The toy histograms of all mass points are obtained from a
+# single product with the (event x bin) matrix of weights.
+all_bins = [(mass, ibin) for mass in masspoints
+            for ibin in range(1, len(tau_ws[mass]) + 1)]
+
+# Columns of the bins of every mass point
+bin_slices = {}
+for mass in masspoints:
+    cols = [i for i, (m, ibin) in enumerate(all_bins) if m == mass]
+    bin_slices[mass] = slice(cols[0], cols[-1] + 1)
 
-    for mass in masspoints:
-        hist = df.groupby(f"PNN{mass}Bin")["toy_weight"].sum()
 
-        # Make sure that the bins are sorted properly
-        hist.sort_index(inplace=True)
+def bootstrapBlock(start, stop, rng):
+    state = workerState()
+    membership_w = state["membership_w"]
 
-        toy_globs = hist.values * sf[mass]
-        globs.setdefault(mass, []).append((i, toy_globs))
+    pois_weight = rng.poisson(1, size=(stop - start, membership_w.shape[0]))
+    hists = np.asarray(membership_w.T @ pois_weight.T).T
 
-# Sanity checks
-for mass in globs:
-    arr = np.array([x for i, x in globs[mass]])
-    mean = arr.mean(axis=0)
-    var = arr.var(axis=0, ddof=1)
+    # Moment-matched normal approximation for large groups of events
+    # with identical bins for all mass points
+    if "cell_membership" in state:
+        rnd = rng.standard_normal(size=(stop - start, len(state["cell_sumw"])))
+        cell_totals = state["cell_sumw"] + rnd * state["cell_std"]
+        hists += np.asarray(state["cell_membership"].T @ cell_totals.T).T
 
-    if np.any(np.abs(tau_ws[mass] / mean) - 1 > 1e-2):
-        print("Possibly problematic toy:")
-        print(f"Mass: {mass}")
-        print(f"{tau_ws[mass] / mean}")
+    # Blocks of different workers are disjoint
+    state["output"][start:stop] = hists * state["sf"]
 
-# Write trees
-for mass in globs:
-    fn_out = os.path.join(args.outdir, f"toy_globs_{args.channel.lower()}_{mass}.root")
-    fout = R.TFile.Open(fn_out, "RECREATE")
 
-    tree = R.TTree(f"globs_{args.channel.lower()}", f"globs_{args.channel.lower()}")
-    tree.SetDirectory(fout)
+if args.approx:
+    cells, cell_index = getCells(df, by_sample=False, return_index=True)
+    ncells = len(cells)
 
-    nbins = len(tau_ws[mass])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cell_tau = cells["weight"]**2 / cells["weightSquared"]
 
-    tree_index = np.zeros(1, dtype=np.int32)
-    tree_globs = np.zeros(nbins, dtype=np.float32)
+    approx = ((cells["count"] >= args.approx_min_events)
+              & (cell_tau >= args.approx_min_tau)).to_numpy()
+    exact_events = ~approx[cell_index]
 
-    tree.Branch("index", tree_index, "index/I")
-    tree.Branch("globs", tree_globs, f"globs[{nbins}]/F")
+    print(f"Groups of events: {ncells}")
+    print(f"Groups using normal approximation: {np.count_nonzero(approx)}")
+    print(f"Events using exact bootstrap: {np.count_nonzero(exact_events)} / {len(df)}")
 
-    # Iterate over index, global observables and fill tree
-    for i, g in sorted(globs[mass], key=lambda x: x[0]):
-        tree_index[0] = i
-        np.copyto(tree_globs, g)
-        tree.Fill()
+    cells_approx = cells.loc[approx]
+    state = {
+        "membership_w": getBinMembership(df.loc[exact_events], all_bins,
+                                         weights=df.loc[exact_events, "weight"]),
+        "cell_membership": getBinMembership(cells_approx, all_bins),
+        "cell_sumw": cells_approx["weight"].to_numpy(),
+        "cell_std": np.sqrt(cells_approx["weightSquared"].to_numpy()),
+    }
+else:
+    state = {
+        "membership_w": getBinMembership(df, all_bins, weights=df["weight"]),
+    }
+
+del df
+
+# Event weights / bins and the output in shared memory so that the
+# memory usage does not grow with the number of workers (released when
+# leaving the block, also on errors)
+with SharedArrays() as shared:
+    state["membership_w"] = shared.copySparse(state["membership_w"])
+    if args.approx:
+        state["cell_membership"] = shared.copySparse(state["cell_membership"])
+    state["output"] = shared.zeros((args.ntoys, len(all_bins)), dtype=np.float64)
+    state["sf"] = np.concatenate([sf[mass] for mass in masspoints])
+
+    blocks = imapBlocks(bootstrapBlock, args.ntoys, args.block_size, seed,
+                        jobs=args.jobs, state=state)
+
+    time_start = time.perf_counter()
+    for start, stop, block in tqdm(blocks, total=len(toyBlocks(args.ntoys, args.block_size))):
+        pass
+
+    time_elapsed = time.perf_counter() - time_start
+    print(f"Throughput: {args.ntoys / time_elapsed:.1f} toys / s ({args.jobs} jobs)")
+
+    globs = {mass: state["output"][:, bin_slices[mass]] for mass in masspoints}
+
+    # Sanity checks
+    for mass in globs:
+        arr = globs[mass]
+        mean = arr.mean(axis=0)
+        var = arr.var(axis=0, ddof=1)
+
+        if args.approx:
+            # Mean and variance of the exact bootstrap
+            exact_mean = sumw[mass] * sf[mass]
+            exact_var = sumw2[mass] * sf[mass]**2
+
+            with np.printoptions(precision=4, suppress=True):
+                print(f"Mass: {mass}")
+                print(f"Relative deviation of mean from exact bootstrap:\n{mean / exact_mean - 1}")
+                print(f"Relative deviation of variance from exact bootstrap:\n{var / exact_var - 1}\n")
+
+        if np.any(np.abs(tau_ws[mass] / mean) - 1 > 1e-2):
+            print("Possibly problematic toy:")
+            print(f"Mass: {mass}")
+            print(f"{tau_ws[mass] / mean}")
+
+    # Write trees
+    for mass in globs:
+        fn_out = os.path.join(args.outdir, f"toy_globs_{args.channel.lower()}_{mass}.root")
+        writeGlobsTree(fn_out, f"globs_{args.channel.lower()}", globs[mass],
+                       basket_size=args.basket_size, compression=args.compression)
 
-    tree.Write()
-    fout.Close()
@@ -1,17 +1,37 @@
 #!/usr/bin/env python3
+from functools import partial
 import argparse
 import numpy as np
 import pandas as pd
 
+from column_utils import writeColumns
+from ntuple_utils import readTrees
 from utils import masspoints, addHeavyFlavourSplit
-from hadhad_utils import getHadhadDf, edgesHadhad
+from hadhad_utils import getHadhadDf
+from binning_utils import binningRegistry
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("ntuple")
 parser.add_argument("-o", "--outfile", required=True)
+parser.add_argument("-j", "--jobs", type=int, default=1,
+                    help="Number of trees read in parallel")
+parser.add_argument("--step-size", default="100 MB",
+                    help="Size of the chunks read from the ntuple")
+parser.add_argument("--format", choices=["hdf", "columns"], default="hdf",
+                    help="HDF5 table or directory with memory-mappable columns "
+                    "(see column_utils.py)")
+parser.add_argument("--weight-dtype", choices=["float32", "float64"], default="float64",
+                    help="Type of the weights in the columnar format")
+parser.add_argument("--keep-scores", action="store_true",
+                    help="Also store the PNN scores in the columnar format")
+parser.add_argument("--binning", default=None,
+                    help="Binning file from parseBins.py (default: $BINNING_FILE or binning.h5)")
 args = parser.parse_args()
 
+if args.binning is not None:
+    binningRegistry.configure(args.binning)
+
 
 treenames = [
     "data",
@@ -24,9 +44,8 @@ treenames = [
     "singletop", "ttbar", "ttbarFakesMC",
 ]
 
-dfs = []
-for tree in treenames:
-    dfs.append(getHadhadDf(args.ntuple, tree))
+dfs = readTrees(partial(getHadhadDf, step_size=args.step_size),
+                args.ntuple, treenames, jobs=args.jobs)
 
 df = pd.concat(dfs)
 del dfs
@@ -49,7 +68,7 @@ print(
 # Adding bin indices
 for mass in masspoints:
     # Get bin edges
-    edges = edgesHadhad[mass]
+    edges = binningRegistry.edges("hadhad")[mass]
 
     # Discretize MVA scores according to binning
     idx = np.digitize(df[f"PNN{mass}"], bins=edges)
@@ -63,4 +82,7 @@ for mass in masspoints:
 
     df[f"PNN{mass}Bin"] = idx.astype(np.uint8)
 
-df.to_hdf(args.outfile, "df_hadhad", complevel=9, format="table")
+if args.format == "columns":
+    writeColumns(args.outfile, df, weight_dtype=args.weight_dtype, keep_scores=args.keep_scores)
+else:
+    df.to_hdf(args.outfile, "df_hadhad", complevel=9, format="table")
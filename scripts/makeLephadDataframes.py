@@ -1,18 +1,38 @@
 #!/usr/bin/env python3
+from functools import partial
 import argparse
 import numpy as np
 import pandas as pd
 
+from column_utils import writeColumns
+from ntuple_utils import readTrees
 from utils import masspoints, addHeavyFlavourSplit
-from lephad_utils import getLephadDf, edgesSLT, edgesLTT
+from lephad_utils import getLephadDf
+from binning_utils import binningRegistry
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("ntuple")
 parser.add_argument("-o", "--outfile", required=True)
+parser.add_argument("-j", "--jobs", type=int, default=1,
+                    help="Number of trees read in parallel")
+parser.add_argument("--step-size", default="100 MB",
+                    help="Size of the chunks read from the ntuple")
+parser.add_argument("--format", choices=["hdf", "columns"], default="hdf",
+                    help="HDF5 table or directory with memory-mappable columns "
+                    "(see column_utils.py)")
+parser.add_argument("--weight-dtype", choices=["float32", "float64"], default="float64",
+                    help="Type of the weights in the columnar format")
+parser.add_argument("--keep-scores", action="store_true",
+                    help="Also store the PNN scores in the columnar format")
 parser.add_argument("-c", "--channel", choices=["SLT", "LTT"], required=True)
+parser.add_argument("--binning", default=None,
+                    help="Binning file from parseBins.py (default: $BINNING_FILE or binning.h5)")
 args = parser.parse_args()
 
+if args.binning is not None:
+    binningRegistry.configure(args.binning)
+
 
 treenames = [
     "ttbar",
@@ -27,11 +47,8 @@ treenames = [
 ]
 
 
-dfs = []
-for tree in treenames:
-    dfs.append(getLephadDf(args.ntuple, tree))
-
-dfs.append(getLephadDf(args.ntuple, "Fake"))
+dfs = readTrees(partial(getLephadDf, step_size=args.step_size),
+                args.ntuple, treenames + ["Fake"], jobs=args.jobs)
 
 df = pd.concat(dfs)
 del dfs
@@ -51,13 +68,7 @@ print(
 # Adding bin indices
 for mass in masspoints:
     # Get bin edges for channel
-    edges = None
-    if args.channel == "SLT":
-        edges = edgesSLT[mass]
-    elif args.channel == "LTT":
-        edges = edgesLTT[mass]
-    else:
-        raise RuntimeError(f"Unknown channel: {args.channel}")
+    edges = binningRegistry.edges(args.channel.lower())[mass]
 
     # Discretize MVA scores according to binning
     idx = np.digitize(df[f"PNN{mass}"], bins=edges)
@@ -80,4 +91,7 @@ elif args.channel == "LTT":
 else:
     raise RuntimeError(f"Unknown channel: {args.channel}")
 
-df.to_hdf(args.outfile, df_name, complevel=9, format="table")
+if args.format == "columns":
+    writeColumns(args.outfile, df, weight_dtype=args.weight_dtype, keep_scores=args.keep_scores)
+else:
+    df.to_hdf(args.outfile, df_name, complevel=9, format="table")
@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-from math import sqrt
 from tqdm import tqdm
 import argparse
 import h5py
@@ -7,8 +6,8 @@ import numpy as np
 import os
 
 from utils import masspoints
-from hadhad_utils import edgesHadhad, edgesHadhadPreRebin
-from lephad_utils import edgesSLT, edgesLTT, edgesLephadPreRebin
+from binning_utils import binningRegistry
+from pseudodata_utils import PseudoDataStoreWriter, PseudoDataWriter, getTargetIndices
 
 import ROOT as R
 R.gROOT.SetBatch(True)
@@ -19,75 +18,63 @@ parser.add_argument("infile")
 parser.add_argument("-o", "--outdir", required=True)
 parser.add_argument("-c", "--channel", choices=["Hadhad", "SLT", "LTT"], required=True)
 parser.add_argument("--nToys", default=20000, type=int)
+parser.add_argument("--chunk-size", default=1000, type=int,
+                    help="Number of toys filled and written at once")
+parser.add_argument("--format", choices=["root", "hdf5"], default="root",
+                    help="ROOT files with histograms PseudoData{i} per mass point or "
+                    "a single compact HDF5 store (see pseudodata_utils.PseudoDataStore)")
+parser.add_argument("--binning", default=None,
+                    help="Binning file from parseBins.py (default: $BINNING_FILE or binning.h5)")
 args = parser.parse_args()
 
+if args.binning is not None:
+    binningRegistry.configure(args.binning)
+
 
 # Figure out what binning to use
-binning = None
-binningPostRebin = None
-if args.channel == "Hadhad":
-    binning = edgesHadhadPreRebin
-    binningPostRebin = edgesHadhad
-elif args.channel == "SLT":
-    binning = edgesLephadPreRebin
-    binningPostRebin = edgesSLT
-elif args.channel == "LTT":
-    binning = edgesLephadPreRebin
-    binningPostRebin = edgesLTT
-else:
-    raise RuntimeError("Unknown channel")
+binning = binningRegistry.preRebinEdges(args.channel.lower())
 
 
 # Histogram prototype for cloning
 proto_hist = R.TH1F("proto", "", len(binning) - 1, binning)
 
-# Center of the bins after rebinning
-centers = {}
-for mass in masspoints:
-    centers[mass] = 0.5 * (binningPostRebin[mass][:-1] + binningPostRebin[mass][1:])
-
 # Mapping between post-rebin bin index to pre-rebin bin center
-#
-# Can just put data at center of bin since the rebinning will again be
-# performed when building the workspace.
-bin_idx_map = {}
-for mass in masspoints:
-    # Using `side="right"` to mimic ROOT convention of 0 being underflow bin
-    bin_idx_map[mass] = np.searchsorted(binning, centers[mass], side="right")
+bin_idx_map = binningRegistry.binIndexMap(args.channel.lower())
 
 
 # Poisson random variables to use for WS inputs
+#
+# Toys are read and written in chunks for all mass points at once so
+# that the memory usage does not depend on the number of toys.
 with h5py.File(args.infile, "r") as fin:
-    # Only use the first couple of toys
-    rvs = np.array(fin.get("poisson_rvs")[:args.nToys])
+    rvs = fin.get("poisson_rvs")
     bin_labels = np.array(fin.get("bin_labels"))
 
-
-# Making empty histograms to fill
-hists = {mass: [] for mass in masspoints}
-for mass in hists:
-    for itoy in range(args.nToys):
-        h = proto_hist.Clone(f"PseudoData{itoy}")
-        h.SetTitle(f"PseudoData{itoy}")
-        h.SetDirectory(0)
-        hists[mass].append(h)
-
-
-print("Filling histograms...")
-for itoy in tqdm(range(args.nToys)):
-    row = rvs[itoy, :]
-    for entries, (mass, ibin) in zip(row, bin_labels):
-        target_index = int(bin_idx_map[mass][ibin - 1])
-        hists[mass][itoy].SetBinContent(target_index, entries)
-        hists[mass][itoy].SetBinError(target_index, sqrt(entries))
-
-
-print("Writing histograms...")
-for mass in tqdm(hists):
-    fn_out = os.path.join(args.outdir, f"pseudodata_{args.channel.lower()}_{mass}.root")
-    fout = R.TFile.Open(fn_out, "RECREATE")
-
-    for hist in hists[mass]:
-        hist.Write()
-
-    fout.Close()
+    # Only use the first couple of toys
+    ntoys = min(args.nToys, rvs.shape[0])
+    targets = getTargetIndices(bin_labels, bin_idx_map)
+
+    writers = {}
+    if args.format == "hdf5":
+        fout = h5py.File(os.path.join(args.outdir, f"pseudodata_{args.channel.lower()}.h5"), "w")
+        for mass in masspoints:
+            writers[mass] = PseudoDataStoreWriter(fout, mass, binning, targets[mass][1])
+    else:
+        for mass in masspoints:
+            fn_out = os.path.join(args.outdir, f"pseudodata_{args.channel.lower()}_{mass}.root")
+            writers[mass] = PseudoDataWriter(fn_out, proto_hist, targets[mass][1])
+
+    print("Filling and writing histograms...")
+    for start in tqdm(range(0, ntoys, args.chunk_size)):
+        stop = min(start + args.chunk_size, ntoys)
+        rows = rvs[start:stop]
+
+        for mass in masspoints:
+            columns, _ = targets[mass]
+            writers[mass].write(start, rows[:, columns])
+
+    for writer in writers.values():
+        writer.close()
+
+    if args.format == "hdf5":
+        fout.close()
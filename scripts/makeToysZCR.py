@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 import argparse
+import h5py
 import numpy as np
 import os
-from scipy import stats
 from tqdm import tqdm
+import uproot
 
+from parallel_utils import imapBlocks, toyBlocks, workerState
+from pseudodata_utils import PseudoDataStoreWriter, PseudoDataWriter
+from tree_utils import writeGlobsTree
 from utils import masspoints
 
 import ROOT as R
@@ -14,90 +18,93 @@ R.gROOT.SetBatch(True)
 parser = argparse.ArgumentParser()
 parser.add_argument("asimov")
 parser.add_argument("-o", "--outdir", default="")
+parser.add_argument("--ntoys", type=int, default=20000)
+parser.add_argument("--block-size", type=int, default=20000,
+                    help="Number of toys drawn at once")
+parser.add_argument("-j", "--jobs", type=int, default=1)
+parser.add_argument("--basket-size", type=int, default=10000,
+                    help="Number of entries per basket of the output tree")
+parser.add_argument("--compression", default="zlib:1",
+                    help="Compression of the global observables (e.g. zlib:1, lzma:9, none)")
+parser.add_argument("--format", choices=["root", "hdf5"], default="root",
+                    help="Format of the pseudo-data (see makePseudoDataHists.py)")
 args = parser.parse_args()
 
 
-rng = np.random.default_rng(45402781074)
+# Independent random streams for pseudo-data and global observables
+seed_pd, seed_globs = np.random.SeedSequence(45402781074).spawn(2)
 
-fin = R.TFile.Open(args.asimov)
 
 # Z-CR is independent of the signal mass hypothesis so all histograms
 # should be identical (check that this is true)
-obs_zcr = None
-tau_zcr = None
+def getZCR(fin, name):
+    """Returns contents (including under- / overflow) and edges of the Z-CR histogram"""
+    contents = [fin[f"{name}_m{mass}"].values(flow=True) for mass in masspoints]
+    if len({len(c) for c in contents}) != 1:
+        raise RuntimeError(f"Number of bins of {name} differs between mass points")
+
+    contents = np.array(contents)
+    differs = np.any(np.abs(contents - contents[0]) >= 1e-12, axis=1)
+    if np.any(differs):
+        masses = [mass for mass, d in zip(masspoints, differs) if d]
+        raise RuntimeError(f"{name} differs from mX = {masspoints[0]} GeV for mX = {masses} GeV")
 
-for mass in masspoints:
     # Use the first point as 'default'
-    if not obs_zcr:
-        obs_zcr = fin.Get(f"obs_zcr_m{mass}").Clone("obs_zcr")
-        obs_zcr.SetDirectory(0)
-    if not tau_zcr:
-        tau_zcr = fin.Get(f"tau_zcr_m{mass}").Clone("tau_zcr")
-        tau_zcr.SetDirectory(0)
+    return contents[0], fin[f"{name}_m{masspoints[0]}"].axis().edges()
 
-    # Check that first point agrees with all others
-    obs = fin.Get(f"obs_zcr_m{mass}")
-    tau = fin.Get(f"tau_zcr_m{mass}")
 
-    nbins = obs.GetNbinsX()
-    assert nbins == tau.GetNbinsX()
-    assert nbins == obs_zcr.GetNbinsX()
-    assert nbins == tau_zcr.GetNbinsX()
+with uproot.open(args.asimov) as fin:
+    exp, edges = getZCR(fin, "obs_zcr")
+    tau, _ = getZCR(fin, "tau_zcr")
 
-    for i in range(nbins + 2):
-        assert abs(obs_zcr.GetBinContent(i) - obs.GetBinContent(i)) < 1e-12
-        assert abs(tau_zcr.GetBinContent(i) - tau.GetBinContent(i)) < 1e-12
+if len(exp) != len(tau):
+    raise RuntimeError("Number of bins of obs_zcr and tau_zcr differ")
 
-fin.Close()
 
-
-nbins = obs_zcr.GetNbinsX()
-exp = np.array([obs_zcr.GetBinContent(i) for i in range(nbins + 2)])
-tau = np.array([tau_zcr.GetBinContent(i) for i in range(nbins + 2)])
-
-pois_exp = stats.poisson(mu=exp)
-pois_tau = stats.poisson(mu=tau)
+def drawBlock(start, stop, rng):
+    mu = workerState()["mu"]
+    return rng.poisson(mu, size=(stop - start, len(mu)))
 
 
 # Pseudo-data (PD)
-fn_out = os.path.join(args.outdir, "pseudodata_ZCR.root")
-fout = R.TFile.Open(fn_out, "RECREATE")
+#
+# All bins including under- / overflow are filled
+target_index = np.arange(len(exp))
 
-for i in tqdm(range(20000)):
-    pd = pois_exp.rvs(random_state=rng)
+if args.format == "hdf5":
+    fout = h5py.File(os.path.join(args.outdir, "pseudodata_ZCR.h5"), "w")
+    writer = PseudoDataStoreWriter(fout, "ZCR", edges, target_index)
+else:
+    fin = R.TFile.Open(args.asimov)
+    proto_hist = fin.Get(f"obs_zcr_m{masspoints[0]}").Clone("obs_zcr")
+    proto_hist.SetDirectory(0)
+    proto_hist.Reset()
+    fin.Close()
 
-    h_pd = obs_zcr.Clone()
-    h_pd.Reset()
-    h_pd.SetName(f"PseudoData{i}")
-    h_pd.SetTitle(f"PseudoData{i}")
+    writer = PseudoDataWriter(os.path.join(args.outdir, "pseudodata_ZCR.root"),
+                              proto_hist, target_index)
 
-    for ibin in range(nbins + 2):
-        h_pd.SetBinContent(ibin, pd[ibin])
+blocks = imapBlocks(drawBlock, args.ntoys, args.block_size, seed_pd,
+                    jobs=args.jobs, state={"mu": exp})
 
-    h_pd.Write()
+for start, stop, block in tqdm(blocks, total=len(toyBlocks(args.ntoys, args.block_size))):
+    writer.write(start, block)
 
-fout.Close()
+writer.close()
+if args.format == "hdf5":
+    fout.close()
 
 
 # Global observables (Barlow-Beeston)
 fn_out = os.path.join(args.outdir, "toy_globs_ZCR.root")
 
-f = R.TFile.Open(fn_out, "RECREATE")
-tree = R.TTree("globs_ZCR", "globs_ZCR")
-tree.SetDirectory(f)
+blocks = imapBlocks(drawBlock, args.ntoys, args.block_size, seed_globs,
+                    jobs=args.jobs, state={"mu": tau})
 
 # Care: we don't store under-/ overflow bins (hence: len(tau) - 2)
-tree_index = np.zeros(1, dtype=np.int32)
-tree_globs = np.zeros(len(tau) - 2, dtype=np.float32)
-
-tree.Branch("index", tree_index, "index/I")
-tree.Branch("globs", tree_globs, f"globs[{len(tau) - 2}]/F")
-
-for i in tqdm(range(20000)):
-    globs = pois_tau.rvs(random_state=rng)
-    tree_index[0] = i
-    np.copyto(tree_globs, globs[1:-1])
-    tree.Fill()
+globs = np.zeros((args.ntoys, len(tau) - 2), dtype=np.float32)
+for start, stop, block in tqdm(blocks, total=len(toyBlocks(args.ntoys, args.block_size))):
+    globs[start:stop] = block[:, 1:-1]
 
-tree.Write()
-fout.Close()
+writeGlobsTree(fn_out, "globs_ZCR", globs,
+               basket_size=args.basket_size, compression=args.compression)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+import argparse
+
+from corr_utils import combineSamples, getSampleScales
+from corr_utils import mergePartials, writeCorr, writePartial
+from utils import defaultNormFactors
+
+
+def parseScale(s):
+    name, value = s.split("=")
+    return name, float(value)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("infiles", nargs="+", help="Partial sums from makeCorr.py --partial")
+parser.add_argument("-o", "--outfile", required=True)
+parser.add_argument("--veto-negative-rates", action="store_true")
+parser.add_argument("--partial", action="store_true",
+                    help="Write merged partial sums instead of the correlation matrix")
+parser.add_argument("-s", "--scale", type=parseScale, action="append", default=[],
+                    help="Scale factor for a normalization factor or sample "
+                    "(e.g. Zhf=1.35 or Zttbb=1.2). Default: "
+                    + " ".join(f"{k}={v}" for k, v in defaultNormFactors.items()))
+args = parser.parse_args()
+
+
+all_bins, cooc_sumw, cooc_sumw2, provenance = mergePartials(args.infiles)
+print(f"Merged {len(args.infiles)} partial sums for {len(all_bins)} bins")
+
+if args.partial:
+    writePartial(args.outfile, all_bins, cooc_sumw, cooc_sumw2, provenance)
+else:
+    norm_factors = dict(defaultNormFactors)
+    norm_factors.update(args.scale)
+
+    scales = getSampleScales(cooc_sumw, norm_factors)
+    for sample in sorted(scales):
+        print(f"Scale factor {sample}: {scales[sample]}")
+
+    sumw, sumw2 = combineSamples(cooc_sumw, cooc_sumw2, scales)
+    writeCorr(args.outfile, all_bins, sumw, args.veto_negative_rates)
@@ -0,0 +1,66 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import multiprocessing.util
+import uproot
+
+
+# Files opened with `openFile` in this process
+_files = {}
+
+
+def openFile(filename):
+    """Returns the file opened with uproot (only opened once per process)"""
+    if filename not in _files:
+        _files[filename] = uproot.open(filename)
+
+    return _files[filename]
+
+
+def closeFiles():
+    for fin in _files.values():
+        fin.close()
+
+    _files.clear()
+
+
+def _initWorker():
+    # Forked workers do not run atexit handlers but the finalizers
+    multiprocessing.util.Finalize(None, closeFiles, exitpriority=0)
+
+
+def iterateTree(filename, treename, expressions, step_size, library):
+    """Yields (arrays, entry start, entry stop) of chunks of a tree
+
+    The file is opened once per process (see `openFile`) and stays open
+    for the following trees. Unlike `tree.iterate`, at least one
+    (possibly empty) chunk is yielded.
+    """
+    tree = openFile(filename)[treename]
+
+    if tree.num_entries == 0:
+        yield tree.arrays(expressions, entry_stop=0, library=library), 0, 0
+        return
+
+    for arrays, report in tree.iterate(expressions, step_size=step_size,
+                                       library=library, report=True):
+        yield arrays, report.start, report.stop
+
+
+def readTrees(func, filename, treenames, jobs=1):
+    """Returns [func(filename, treename) for treename in treenames]
+
+    The trees are read in a pool of `jobs` processes. Every process opens
+    the file once and closes it when it exits. The results are returned
+    in the order of `treenames`.
+    """
+    if jobs == 1:
+        try:
+            return [func(filename, treename) for treename in treenames]
+        finally:
+            closeFiles()
+
+    # Files are only opened (and closed) in the workers, forking is safe
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                             initializer=_initWorker) as pool:
+        return list(pool.map(func, [filename] * len(treenames), treenames))
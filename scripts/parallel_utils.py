@@ -0,0 +1,132 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import multiprocessing
+import numpy as np
+
+
+# Read-only state of the worker processes (inherited when forking)
+_worker_state = {}
+
+
+def workerState():
+    """Returns the state passed to `imapBlocks`"""
+    return _worker_state
+
+
+def toyBlocks(ntoys, block_size):
+    """Returns list of (start, stop) of blocks of toys"""
+    return [(start, min(start + block_size, ntoys))
+            for start in range(0, ntoys, block_size)]
+
+
+def blockSeeds(seed, nblocks):
+    """Returns independent seed sequences for every block"""
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    return seed.spawn(nblocks)
+
+
+def _runBlock(func, start, stop, seed):
+    return func(start, stop, np.random.default_rng(seed))
+
+
+def imapBlocks(func, ntoys, block_size, seed, jobs=1, state=None):
+    """Yields (start, stop, result) of `func(start, stop, rng)` for blocks of toys
+
+    The toys are split into blocks of fixed size and every block gets
+    its own random number generator spawned from `seed` by the block
+    index. Therefore, the results do not depend on the number of jobs.
+
+    The blocks are processed in a pool of `jobs` (forked) processes that
+    can access `state` with `workerState()`. Results are yielded in the
+    order of the blocks.
+    """
+    blocks = toyBlocks(ntoys, block_size)
+    seeds = blockSeeds(seed, len(blocks))
+
+    _worker_state.clear()
+    _worker_state.update(state or {})
+
+    if jobs == 1:
+        for (start, stop), block_seed in zip(blocks, seeds):
+            yield start, stop, _runBlock(func, start, stop, block_seed)
+        return
+
+    # Forking shares the state with the workers without copying
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        tasks = iter(zip(blocks, seeds))
+        pending = deque()
+
+        def submit():
+            for (start, stop), block_seed in tasks:
+                future = pool.submit(_runBlock, func, start, stop, block_seed)
+                pending.append((start, stop, future))
+                return
+
+        # Limit number of blocks in flight to bound the memory usage
+        for _ in range(2 * jobs):
+            submit()
+
+        while pending:
+            start, stop, future = pending.popleft()
+            result = future.result()
+            submit()
+            yield start, stop, result
+
+
+class SharedArrays:
+    """Creates numpy arrays in shared memory
+
+    Forked worker processes see the same memory, i.e. read-only inputs
+    are not copied and outputs written by the workers are visible in the
+    parent process. The memory is released by `close` (or when used as
+    a context manager), the arrays must not be used afterwards.
+    """
+
+    def __init__(self):
+        self._shms = []
+
+    def empty(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self._shms.append(shm)
+
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def zeros(self, shape, dtype):
+        arr = self.empty(shape, dtype)
+        arr[...] = 0
+        return arr
+
+    def copy(self, arr):
+        arr = np.asarray(arr)
+        shared = self.empty(arr.shape, arr.dtype)
+        shared[...] = arr
+        return shared
+
+    def copySparse(self, mat):
+        """Returns copy of a CSR / CSC matrix with arrays in shared memory"""
+        cls = type(mat)
+        return cls((self.copy(mat.data), self.copy(mat.indices), self.copy(mat.indptr)),
+                   shape=mat.shape, copy=False)
+
+    def close(self):
+        for shm in self._shms:
+            # Unlink even if the segment cannot be closed
+            try:
+                shm.close()
+            finally:
+                shm.unlink()
+
+        self._shms = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
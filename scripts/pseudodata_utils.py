@@ -0,0 +1,164 @@
+import h5py
+import numpy as np
+
+from toy_utils import appendRows, createRowDataset
+
+
+def getTargetIndices(bin_labels, bin_idx_map):
+    """Returns (columns, pre-rebin bin indices) of the bin labels per mass"""
+    targets = {}
+    for mass in bin_idx_map:
+        columns = np.flatnonzero(bin_labels[:, 0] == mass)
+        target_index = bin_idx_map[mass][bin_labels[columns, 1] - 1]
+        targets[mass] = (columns, target_index)
+
+    return targets
+
+
+def scatterToHists(counts, target_index, ncells):
+    """Returns (toy x cell) contents with `counts` placed in the target cells"""
+    content = np.zeros((counts.shape[0], ncells), dtype=np.float64)
+    content[:, target_index] = counts
+    return content
+
+
+class PseudoDataWriter:
+    """Writes histograms `PseudoData{i}` to a ROOT file
+
+    Histograms are written (and released) as soon as they are filled, so
+    the memory usage does not depend on the number of toys.
+    """
+
+    def __init__(self, filename, proto_hist, target_index):
+        import ROOT as R
+
+        self.fout = R.TFile.Open(filename, "RECREATE")
+        self.proto_hist = proto_hist
+        self.target_index = target_index
+
+    def write(self, start, counts):
+        """Writes toys `start`, `start + 1`, ... from (toy x target bin) counts
+
+        Errors are set to the square root of the contents.
+        """
+        content = scatterToHists(counts, self.target_index, self.proto_hist.GetNcells())
+        errors = np.sqrt(content)
+
+        for i in range(content.shape[0]):
+            h = self.proto_hist.Clone(f"PseudoData{start + i}")
+            h.SetTitle(f"PseudoData{start + i}")
+            h.SetDirectory(0)
+
+            fillHist(h, content[i], errors[i], len(self.target_index))
+            self.fout.WriteTObject(h)
+
+    def close(self):
+        self.fout.Close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def fillHist(h, content, errors, entries):
+    h.SetContent(content)
+    h.SetError(errors)
+    # Same number of entries as setting the target bins one by one
+    h.SetEntries(entries)
+
+
+# Compact alternative to the ROOT files: Per channel and mass point, only
+# the counts of the target bins are stored as a (toy x target bin) array
+# together with the pre-rebin binning.
+pseudoDataStoreVersion = 1
+
+
+class PseudoDataStoreWriter:
+    """Writes pseudo-data of one group (e.g. mass point) to an HDF5 store"""
+
+    def __init__(self, fout, group, edges, target_index, chunk_rows=256):
+        fout.attrs["version"] = pseudoDataStoreVersion
+
+        self.group = fout.create_group(str(group))
+        self.group.create_dataset("edges", data=np.asarray(edges, dtype=np.float64))
+        self.group.create_dataset("target_index", data=np.asarray(target_index, dtype=np.int64))
+
+        self.dset = createRowDataset(self.group, "counts", len(target_index), chunk_rows,
+                                     compression="gzip", shuffle=True)
+
+    def write(self, start, counts):
+        if start != self.dset.shape[0]:
+            raise RuntimeError("Toys have to be written in order")
+
+        appendRows(self.dset, counts)
+
+    def close(self):
+        # File is owned by the caller
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PseudoDataStore:
+    """Reads pseudo-data of one group (e.g. mass point) from an HDF5 store"""
+
+    def __init__(self, filename, group):
+        # Chunk cache large enough for sequential access to the toys
+        self.fin = h5py.File(filename, "r", rdcc_nbytes=16 * 1024**2)
+        if self.fin.attrs.get("version") != pseudoDataStoreVersion:
+            raise RuntimeError(f"Unsupported version of pseudo-data store: {filename}")
+
+        self.group = self.fin[str(group)]
+        self.counts = self.group["counts"]
+        self.edges = np.array(self.group["edges"])
+        self.target_index = np.array(self.group["target_index"])
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    @property
+    def ncells(self):
+        # Including under- / overflow
+        return len(self.edges) + 1
+
+    def toy(self, i):
+        """Returns counts of the target bins of toy i"""
+        return self.counts[i]
+
+    def hist(self, i):
+        """Returns contents of all cells (including under- / overflow) of toy i"""
+        return scatterToHists(self.counts[i][np.newaxis, :], self.target_index, self.ncells)[0]
+
+    def th1(self, i):
+        """Returns toy i as histogram `PseudoData{i}` (TH1F)"""
+        import ROOT as R
+
+        content = self.hist(i)
+
+        h = R.TH1F(f"PseudoData{i}", f"PseudoData{i}", len(self.edges) - 1, self.edges)
+        h.SetDirectory(0)
+        fillHist(h, content, np.sqrt(content), len(self.target_index))
+
+        return h
+
+    def Get(self, name):
+        """Returns histogram `PseudoData{i}` (drop-in for `TFile.Get`)"""
+        if not name.startswith("PseudoData") or not name[len("PseudoData"):].isdigit():
+            raise RuntimeError(f"Unknown histogram: {name}")
+
+        return self.th1(int(name[len("PseudoData"):]))
+
+    def close(self):
+        self.fin.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
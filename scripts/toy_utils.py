@@ -0,0 +1,245 @@
+from scipy import special, stats
+import h5py
+import hashlib
+import numpy as np
+import os
+import tempfile
+import uproot
+
+from utils import masspoints
+
+
+def getExpectedRates(filename, channel, bin_labels):
+    """Returns expected rates from the Asimov dataset for the bin labels"""
+    asimov_hists = {}
+    with uproot.open(filename) as fin:
+        for mass in masspoints:
+            if channel == "Hadhad":
+                hname = f"obs_hh_m{mass}"
+            elif channel == "SLT":
+                hname = f"obs_lh_slt_m{mass}"
+            elif channel == "LTT":
+                hname = f"obs_lh_ltt_m{mass}"
+            else:
+                raise RuntimeError("Unknown channel")
+
+            asimov_hists[mass] = fin[hname].to_numpy()
+
+    mu = []
+    for mass, ibin in bin_labels:
+        hist, edges = asimov_hists[mass]
+        # Histograms loaded with uproot do not contain over / underflows
+        # but these are counted in bin_labels
+        mu.append(hist[ibin - 1])
+
+    return np.array(mu)
+
+
+def truncatedNormal(rng, size, bound):
+    """Returns standard normal random numbers truncated to [-bound, bound]
+
+    Values outside of the bounds are redrawn, i.e. this is only efficient
+    if the probability to be outside is small.
+    """
+    rnd = rng.standard_normal(size)
+
+    outside = np.abs(rnd) > bound
+    while np.any(outside):
+        rnd[outside] = rng.standard_normal(np.count_nonzero(outside))
+        outside = np.abs(rnd) > bound
+
+    return rnd
+
+
+class RunningMoments:
+    """Accumulates mean and covariance of rows from batches"""
+
+    def __init__(self, ndim):
+        self.n = 0
+        self.mean = np.zeros(ndim, dtype=np.float64)
+        # Sum of outer products of deviations from the mean
+        self.m2 = np.zeros((ndim, ndim), dtype=np.float64)
+
+    def update(self, batch):
+        batch = np.asarray(batch, dtype=np.float64)
+        n_batch = batch.shape[0]
+        if n_batch == 0:
+            return
+
+        mean_batch = batch.mean(axis=0)
+        centered = batch - mean_batch
+        m2_batch = centered.T @ centered
+
+        # Combine with previous batches (Chan et al.)
+        n = self.n + n_batch
+        delta = mean_batch - self.mean
+        self.m2 += m2_batch + np.outer(delta, delta) * (self.n * n_batch / n)
+        self.mean += delta * (n_batch / n)
+        self.n = n
+
+    def cov(self, ddof=0):
+        return self.m2 / (self.n - ddof)
+
+    def var(self, ddof=0):
+        return np.diag(self.m2) / (self.n - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof))
+
+    def corr(self):
+        std = np.sqrt(np.diag(self.m2))
+        return self.m2 / np.outer(std, std)
+
+
+def createRowDataset(fout, name, ncols, chunk_rows, dtype=np.float64, **kwargs):
+    """Returns resizable HDF5 dataset to append rows to"""
+    return fout.create_dataset(name, shape=(0, ncols), maxshape=(None, ncols),
+                               chunks=(chunk_rows, ncols), dtype=dtype, **kwargs)
+
+
+def appendRows(dset, rows):
+    start = dset.shape[0]
+    dset.resize(start + rows.shape[0], axis=0)
+    dset[start:] = rows
+
+
+class CorrelatedNormalSampler:
+    """Multivariate normal RVS (zero mean) with given correlation matrix
+
+    Uses the factor `L` (n x rank) of the correlation matrix
+    `corr = L L^T` from the eigenvectors with eigenvalues >= `tolerance`.
+    Only `rank` normals are drawn per RVS.
+    """
+
+    def __init__(self, factor, eigval, tolerance=1e-12):
+        self.eigval = eigval
+        self.factor = factor
+        self.keep = np.flatnonzero(eigval >= tolerance)
+
+        if len(self.keep) != factor.shape[1]:
+            raise RuntimeError("Factor does not match eigenvalues")
+
+    @property
+    def ndim(self):
+        return len(self.eigval)
+
+    @property
+    def rank(self):
+        return self.factor.shape[1]
+
+    @classmethod
+    def fromCorr(cls, corr, tolerance=1e-12):
+        eigval, eigvec = np.linalg.eigh(corr)
+        keep = eigval >= tolerance
+        factor = eigvec[:, keep] * np.sqrt(eigval[keep])
+        return cls(factor, eigval, tolerance)
+
+    @classmethod
+    def fromFile(cls, filename, tolerance=1e-12, cache=None):
+        """Reads correlation matrix from file
+
+        If `cache` is given, the factor is read from / written to that
+        file (keyed by the hash of the correlation matrix). The input file
+        is never modified.
+        """
+        with h5py.File(filename, "r") as fin:
+            corr = np.array(fin.get("corr"))
+
+        if cache is None:
+            return cls.fromCorr(corr, tolerance)
+
+        corr_hash = hashlib.sha1(np.ascontiguousarray(corr).tobytes()).hexdigest()
+
+        if os.path.exists(cache):
+            with h5py.File(cache, "r") as fin:
+                dset = fin.get("factor")
+                if dset is not None \
+                   and dset.attrs.get("corr_hash") == corr_hash \
+                   and dset.attrs.get("tolerance") == tolerance:
+                    return cls(np.array(dset), np.array(fin.get("eigval")), tolerance)
+
+        sampler = cls.fromCorr(corr, tolerance)
+
+        # Replace atomically in case of concurrent runs
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache)), suffix=".tmp")
+        os.close(fd)
+        try:
+            with h5py.File(tmp, "w") as fout:
+                dset = fout.create_dataset("factor", data=sampler.factor)
+                dset.attrs["corr_hash"] = corr_hash
+                dset.attrs["tolerance"] = tolerance
+                fout.create_dataset("eigval", data=sampler.eigval)
+
+            os.replace(tmp, cache)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            print(f"Could not cache decomposition in {cache}")
+
+        return sampler
+
+    def rvs(self, size, rng):
+        rnd = rng.standard_normal(size=(size, self.rank))
+        return rnd @ self.factor.T
+
+
+class PoissonQuantileTable:
+    """Quantile function of Poisson distributions with fixed rate per bin
+
+    The CDF of every bin is tabulated once between the `tail` and
+    `1 - tail` quantiles and the inverse is found by binary search.
+
+    The table gives the smallest count with CDF >= q. scipy inverts the
+    CDF numerically (`pdtrik`) and can differ by one count for uniforms
+    very close to a CDF value, in particular at large rates. To give the
+    same results as `stats.poisson.ppf`, uniforms within `ulps` units in
+    the last place of a tabulated CDF value and the rare uniforms outside
+    of the tables are passed to scipy.
+    """
+
+    def __init__(self, mu, tail=1e-10, ulps=64):
+        self.mu = np.asarray(mu, dtype=np.float64)
+        self.ulps = ulps
+
+        self.kmin = stats.poisson.ppf(tail, mu=self.mu).astype(np.int64)
+        kmax = stats.poisson.ppf(1 - tail, mu=self.mu).astype(np.int64)
+
+        # CDF values (same function as used by stats.poisson.cdf)
+        self.tables = [special.pdtr(np.arange(lo, hi + 1), m)
+                       for lo, hi, m in zip(self.kmin, kmax, self.mu)]
+
+        # Range of uniforms covered by the tables
+        self.lower = np.where(self.kmin > 0, special.pdtr(self.kmin - 1, self.mu), 0.0)
+        self.upper = np.array([table[-1] for table in self.tables])
+
+    @property
+    def size(self):
+        return sum(len(table) for table in self.tables)
+
+    def ppf(self, q):
+        """Transforms uniforms of shape (..., nbins) to Poisson counts"""
+        q = np.asarray(q, dtype=np.float64)
+        out = np.empty(q.shape, dtype=np.float64)
+        ambiguous = np.empty(q.shape, dtype=bool)
+
+        for i, table in enumerate(self.tables):
+            idx = np.searchsorted(table, q[..., i], side="left")
+            out[..., i] = self.kmin[i] + idx
+
+            # Closest CDF values below / above the uniforms
+            below = table[np.maximum(idx - 1, 0)]
+            above = table[np.minimum(idx, len(table) - 1)]
+            ambiguous[..., i] = ((np.abs(q[..., i] - below) <= self.ulps * np.spacing(below))
+                                 | (np.abs(q[..., i] - above) <= self.ulps * np.spacing(above)))
+
+        outside = (q <= self.lower) | (q >= self.upper) | ambiguous
+        if np.any(outside):
+            mu = np.broadcast_to(self.mu, q.shape)
+            out[outside] = stats.poisson.ppf(q[outside], mu=mu[outside])
+
+        return out
+
+    def fromNormal(self, rnd):
+        """Transforms standard normals to Poisson counts"""
+        # Identical to stats.norm.cdf
+        return self.ppf(special.ndtr(rnd))
@@ -0,0 +1,57 @@
+import numpy as np
+import uproot
+
+
+compressionAlgorithms = {
+    "zlib": uproot.ZLIB,
+    "lzma": uproot.LZMA,
+    "lz4": uproot.LZ4,
+    "zstd": uproot.ZSTD,
+}
+
+
+def getCompression(spec):
+    """Returns uproot compression from a string like 'zlib:1' ('none' to disable)"""
+    algorithm, _, level = spec.lower().partition(":")
+    if algorithm == "none":
+        return None
+
+    if algorithm not in compressionAlgorithms:
+        raise RuntimeError(f"Unknown compression algorithm: {algorithm}")
+
+    return compressionAlgorithms[algorithm](int(level) if level else 1)
+
+
+def writeGlobsTree(filename, treename, globs, basket_size=10000, compression="zlib:1"):
+    """Writes a tree of global observables with one entry per toy
+
+    If `globs` is a (ntoys x n) array, the tree has the branches
+    `index/I` and `globs[n]/F`. If `globs` is a dict of arrays of
+    length ntoys, the tree has one branch `name/F` per key (in the order
+    of the dict).
+
+    Every basket holds up to `basket_size` entries.
+    """
+    if isinstance(globs, dict):
+        arrays = {name: np.asarray(values, dtype=np.float32)
+                  for name, values in globs.items()}
+        branch_types = {name: np.float32 for name in arrays}
+    else:
+        globs = np.asarray(globs, dtype=np.float32)
+        arrays = {
+            "index": np.arange(len(globs), dtype=np.int32),
+            "globs": globs,
+        }
+        branch_types = {
+            "index": np.int32,
+            "globs": np.dtype((np.float32, globs.shape[1:])),
+        }
+
+    ntoys = len(next(iter(arrays.values())))
+
+    with uproot.recreate(filename, compression=getCompression(compression)) as fout:
+        tree = fout.mktree(treename, branch_types, title=treename)
+
+        for start in range(0, ntoys, basket_size):
+            tree.extend({name: arr[start:start + basket_size]
+                         for name, arr in arrays.items()})
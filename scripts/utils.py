@@ -1,3 +1,7 @@
+import numpy as np
+import pandas as pd
+
+
 masspoints = [
     251, 260, 280, 300, 325, 350, 375, 400,
     450, 500, 550, 600, 700, 800, 900, 1000,
@@ -5,26 +9,75 @@ masspoints = [
 ]
 
 
+# Samples affected by the normalization factors of the fit
+normFactorSamples = {
+    "Zhf": ["Zttbb", "Zttbc", "Zttcc", "Zbb", "Zbc", "Zcc"],
+    "ttbar": ["ttbar", "ttbarFakesMC"],
+}
+
+# Used for the correlation matrices and the Asimov dataset
+defaultNormFactors = {
+    "Zhf": 1.35,
+    "ttbar": 0.97,
+}
+
+
+# Suffixes of the heavy-flavour split of Z+jets by flavour code
+hfSuffixes = ["", "bb", "bc", "cc", "bl", "cl", "l"]
+
+# Flavour code from the classes of the b-jet truth matches (light, c, b,
+# other) of both jets
+_hfCodes = np.array([
+    # light, c, b, other
+    [6, 5, 4, 0],  # light
+    [5, 3, 2, 0],  # c
+    [4, 2, 1, 0],  # b
+    [0, 0, 0, 0],  # other
+])
+
+
+def getFlavourCode(b0, b1):
+    """Returns index into `hfSuffixes` from the b-jet truth matches"""
+    def truthClass(b):
+        cls = np.full(len(b), 3)
+        cls[b == 0] = 0
+        cls[b == 4] = 1
+        cls[b == 5] = 2
+        return cls
+
+    return _hfCodes[truthClass(b0), truthClass(b1)]
+
+
 def addHeavyFlavourSplit(df):
-    mask_zjets = (df["sample"] == "Z") | (df["sample"] == "Ztt")
+    """Splits Z+jets samples by the truth flavour of the b-jets
 
-    # B-jet truth matching
-    b0, b1 = df["b0_truth_match"], df["b1_truth_match"]
+    The sample column is replaced by a categorical (categories in
+    alphabetical order) with labels like `Zttbb` or `Zl`.
+    """
+    sample = pd.Categorical(df["sample"])
+    codes = sample.codes
+    is_zjets = np.isin(sample.categories, ["Z", "Ztt"])
+    mask_zjets = is_zjets[codes]
 
     # Map taus to light
-    df.loc[mask_zjets & (b0 == 15), "b0_truth_match"] = 0
-    df.loc[mask_zjets & (b1 == 15), "b1_truth_match"] = 0
-
-    mask_bb = (b0 == 5) & (b1 == 5)
-    mask_bc = ((b0 == 5) & (b1 == 4)) | ((b0 == 4) & (b1 == 5))
-    mask_cc = (b0 == 4) & (b1 == 4)
-    mask_bl = ((b0 == 5) & (b1 == 0)) | ((b0 == 0) & (b1 == 5))
-    mask_cl = ((b0 == 4) & (b1 == 0)) | ((b0 == 0) & (b1 == 4))
-    mask_l = (b0 == 0) & (b1 == 0)
-
-    df.loc[mask_zjets & mask_bb, "sample"] += "bb"
-    df.loc[mask_zjets & mask_bc, "sample"] += "bc"
-    df.loc[mask_zjets & mask_cc, "sample"] += "cc"
-    df.loc[mask_zjets & mask_bl, "sample"] += "bl"
-    df.loc[mask_zjets & mask_cl, "sample"] += "cl"
-    df.loc[mask_zjets & mask_l, "sample"] += "l"
+    b0 = df["b0_truth_match"].to_numpy()
+    b1 = df["b1_truth_match"].to_numpy()
+
+    b0 = np.where(mask_zjets & (b0 == 15), 0, b0)
+    b1 = np.where(mask_zjets & (b1 == 15), 0, b1)
+
+    df["b0_truth_match"] = b0
+    df["b1_truth_match"] = b1
+
+    flavour = np.where(mask_zjets, getFlavourCode(b0, b1), 0)
+
+    # Lookup table (sample code, flavour code) -> index of label
+    labels = sorted({str(cat) + (suffix if z else "")
+                     for cat, z in zip(sample.categories, is_zjets)
+                     for suffix in hfSuffixes})
+    table = np.array([[labels.index(str(cat) + (suffix if z else "")) for suffix in hfSuffixes]
+                      for cat, z in zip(sample.categories, is_zjets)], dtype=np.int64)
+    table = table.reshape(len(sample.categories), len(hfSuffixes))
+
+    split = pd.Categorical.from_codes(table[codes, flavour], categories=labels)
+    df["sample"] = split.remove_unused_categories()